@@ -0,0 +1,237 @@
+"""Read API over the local transaction store: filtered, paginated queries and streaming exports.
+
+    python3 cli.py query --policy <policy_id> --since 2024-06-01 --limit 50
+    python3 cli.py export --format csv --tx-type CREATION > creations.csv
+    python3 cli.py api    # http://127.0.0.1:9110/txs?policy=<policy_id>&limit=50
+
+Pages are keyset paginated on (tx_date, tx_hash) and exports read the table
+one chunk at a time, so neither ever holds more than a chunk in memory.
+Every filter is served by an index created in storage.init_local_db.
+"""
+import csv
+import http.server
+import io
+import json
+import logging
+import urllib.parse
+from datetime import datetime
+
+import storage
+
+# Columns of the tx table, in export order
+TX_COLUMNS = (
+    'tx_hash', 'tx_date', 'block_no', 'block_hash', 'policy_id', 'tx_type', 'target_address',
+    'target_lovelace_input', 'target_lovelace_output', 'match_lovelace_input', 'match_lovelace_output',
+    'matched_address', 'metadata',
+)
+INTEGER_COLUMNS = {'block_no', 'target_lovelace_input', 'target_lovelace_output', 'match_lovelace_input', 'match_lovelace_output'}
+
+FILTERS = ('wallet', 'policy', 'tx_type', 'address', 'since', 'until')
+
+# Default and maximum page size of queries, and rows read per export chunk
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+EXPORT_CHUNK = 5000
+
+# Local port of the HTTP API
+API_PORT = 9110
+
+log = logging.getLogger('api')
+
+def parse_filters(values):
+    """Build filters from strings (query parameters); since and until are ISO dates"""
+    filters = {name: values[name] for name in FILTERS if values.get(name)}
+    for name in ('since', 'until'):
+        if name in filters and not isinstance(filters[name], datetime):
+            filters[name] = datetime.fromisoformat(filters[name])
+    return filters
+
+def where_conditions(filters):
+    """SQL conditions on tx and their parameters for the given filters"""
+    conditions, params = [], []
+    if filters.get('wallet'):
+        conditions.append("tx.target_address = ?")
+        params.append(filters['wallet'])
+    if filters.get('policy'):
+        conditions.append("tx.policy_id = ?")
+        params.append(filters['policy'])
+    if filters.get('tx_type'):
+        conditions.append("tx.tx_type = ?")
+        params.append(filters['tx_type'])
+    if filters.get('address'):
+        # Any input or output, through idx_tx_io_address
+        conditions.append("tx.tx_hash IN (SELECT tx_hash FROM tx_io WHERE address = ?)")
+        params.append(filters['address'])
+    if filters.get('since'):
+        conditions.append("tx.tx_date >= ?")
+        params.append(filters['since'])
+    if filters.get('until'):
+        conditions.append("tx.tx_date < ?")
+        params.append(filters['until'])
+    return conditions, params
+
+def encode_cursor(row):
+    return f"{row['tx_date']}|{row['tx_hash']}"
+
+def decode_cursor(cursor):
+    tx_date, separator, tx_hash = cursor.partition('|')
+    if not separator:
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return tx_date, tx_hash
+
+def select_txs(conn, filters, limit, after=None, descending=False):
+    """Matching tx rows as dicts in (tx_date, tx_hash) order, starting after a cursor"""
+    conditions, params = where_conditions(filters)
+    if after is not None:
+        conditions.append(f"(tx.tx_date, tx.tx_hash) {'<' if descending else '>'} (?, ?)")
+        params.extend(decode_cursor(after))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    order = 'DESC' if descending else 'ASC'
+    cursor = conn.cursor()
+    cursor.execute(
+        f"""SELECT {', '.join(f'tx.{column}' for column in TX_COLUMNS)}
+        FROM tx
+        {where}
+        ORDER BY tx.tx_date {order}, tx.tx_hash {order}
+        LIMIT ?""",
+        params + [limit]
+    )
+    return [dict(zip(TX_COLUMNS, row)) for row in cursor.fetchall()]
+
+def add_details(conn, rows):
+    """Attach inputs, outputs and watched assets to tx rows, in two queries per call"""
+    by_hash = {}
+    for row in rows:
+        row['metadata'] = json.loads(row['metadata']) if row['metadata'] else {}
+        row['inputs'], row['outputs'], row['assets'] = [], [], []
+        by_hash[row['tx_hash']] = row
+    if not by_hash:
+        return rows
+    placeholders = ','.join('?' * len(by_hash))
+    cursor = conn.cursor()
+    cursor.execute(
+        f"""SELECT tx_hash, direction, address, lovelace FROM tx_io
+        WHERE tx_hash IN ({placeholders}) ORDER BY tx_hash, direction, position""",
+        list(by_hash)
+    )
+    for tx_hash, direction, address, lovelace in cursor.fetchall():
+        by_hash[tx_hash]['inputs' if direction == 'in' else 'outputs'].append({'address': address, 'lovelace': lovelace})
+    cursor.execute(
+        f"""SELECT tx_hash, address, policy_id, asset_name, quantity FROM tx_asset
+        WHERE tx_hash IN ({placeholders}) ORDER BY tx_hash, policy_id, asset_name""",
+        list(by_hash)
+    )
+    for tx_hash, address, policy_id, asset_name, quantity in cursor.fetchall():
+        by_hash[tx_hash]['assets'].append({'address': address, 'policy_id': policy_id, 'asset_name': asset_name, 'quantity': int(quantity)})
+    return rows
+
+def query_page(conn, filters, limit=PAGE_SIZE, cursor=None):
+    """One page of matching transactions with their details, newest first.
+
+    Returns (rows, cursor of the next page or None).
+    """
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    rows = add_details(conn, select_txs(conn, filters, limit, cursor, descending=True))
+    return rows, encode_cursor(rows[-1]) if len(rows) == limit else None
+
+def iter_chunks(conn, filters, details=False, chunk=EXPORT_CHUNK):
+    """Yield lists of matching tx rows oldest first, chunk rows at a time"""
+    after = None
+    while True:
+        rows = select_txs(conn, filters, chunk, after)
+        if not rows:
+            return
+        yield add_details(conn, rows) if details else rows
+        after = encode_cursor(rows[-1])
+
+def write_csv(conn, filters, out):
+    """Stream matching transactions as CSV, one line per tx"""
+    writer = csv.DictWriter(out, TX_COLUMNS)
+    writer.writeheader()
+    for rows in iter_chunks(conn, filters):
+        writer.writerows(rows)
+
+def write_jsonl(conn, filters, out):
+    """Stream matching transactions as JSON lines, with inputs, outputs and assets"""
+    for rows in iter_chunks(conn, filters, details=True):
+        out.write(''.join(json.dumps(row, default=str) + '\n' for row in rows))
+
+def write_parquet(conn, filters, path):
+    """Write matching transactions as Parquet, one row group per chunk; needs pyarrow"""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    schema = pyarrow.schema([
+        (column, pyarrow.int64() if column in INTEGER_COLUMNS else pyarrow.string())
+        for column in TX_COLUMNS
+    ])
+    with pyarrow.parquet.ParquetWriter(path, schema) as writer:
+        for rows in iter_chunks(conn, filters):
+            writer.write_table(pyarrow.Table.from_pylist(rows, schema))
+
+# Streaming export formats served over HTTP: path -> (content type, writer)
+HTTP_EXPORTS = {
+    '/export.csv': ('text/csv; charset=utf-8', write_csv),
+    '/export.jsonl': ('application/x-ndjson', write_jsonl),
+}
+
+class ApiHandler(http.server.BaseHTTPRequestHandler):
+    """GET /txs for paginated JSON, /export.csv and /export.jsonl for streamed exports"""
+
+    db_path = storage.DB_PATH
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        values = {name: value[-1] for name, value in urllib.parse.parse_qs(url.query).items()}
+        if url.path != '/txs' and url.path not in HTTP_EXPORTS:
+            self.send_error(404)
+            return
+        try:
+            filters = parse_filters(values)
+            limit = int(values.get('limit', PAGE_SIZE))
+            if values.get('cursor'):
+                decode_cursor(values['cursor'])
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+
+        # sqlite3 connections stay on the thread that opened them
+        conn = storage.connect_reader(self.db_path)
+        try:
+            if url.path == '/txs':
+                rows, cursor = query_page(conn, filters, limit, values.get('cursor'))
+                body = json.dumps({'txs': rows, 'next_cursor': cursor}, default=str).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            else:
+                content_type, write = HTTP_EXPORTS[url.path]
+                # No Content-Length: the export is streamed and the connection closed after it
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.end_headers()
+                out = io.TextIOWrapper(self.wfile, encoding='utf-8', newline='', write_through=True)
+                write(conn, filters, out)
+                out.flush()
+                out.detach()
+        finally:
+            conn.close()
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+def serve(db_path=storage.DB_PATH, port=API_PORT):
+    """Serve the API on localhost until interrupted"""
+    handler = type('Handler', (ApiHandler,), {'db_path': db_path})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), handler)
+    log.info(f"Serving the transaction API on http://127.0.0.1:{port}/txs")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("API stopped by user")
+    finally:
+        server.server_close()
@@ -0,0 +1,447 @@
+"""Benchmark find_txs.py and tlg.py against a synthetic db-sync dataset.
+
+By default the db-sync queries are answered by an in-memory emulation, which
+times everything but the SQL itself. With --dsn the dataset is loaded into the
+jpg_sniper_bench schema of that (scratch) PostgreSQL database and the real
+prepared queries are timed as well.
+
+    python3 bench.py --txs 100000
+    python3 bench.py --txs 100000 --dsn "dbname=bench"
+"""
+import argparse
+import bisect
+import hashlib
+import http.server
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+import find_txs
+import storage
+import tlg
+from config import Config
+from datum import Constr, PolicyMatcher
+
+BENCH_SCHEMA = 'jpg_sniper_bench'
+
+# Share of generated transactions per pattern; the rest is unrelated traffic
+LISTING_SHARE = 0.02
+OFFER_SHARE = 0.004
+OFFER_UPDATE_SHARE = 0.002
+OFFER_CHANGE_SHARE = 0.002
+
+TXS_PER_BLOCK = 20
+BLOCKS_PER_EPOCH = 21600
+
+def encode_cbor(value):
+    """Encode ints, byte strings, lists, maps and Constr the way Plutus data is serialized"""
+    def head(major, argument):
+        if argument < 24:
+            return bytes([major << 5 | argument])
+        for info, size in ((24, 1), (25, 2), (26, 4), (27, 8)):
+            if argument < 1 << (8 * size):
+                return bytes([major << 5 | info]) + argument.to_bytes(size, 'big')
+
+    if isinstance(value, Constr):
+        return head(6, 121 + value.index) + encode_cbor(value.fields)
+    if isinstance(value, int):
+        return head(0, value) if value >= 0 else head(1, -1 - value)
+    if isinstance(value, bytes):
+        return head(2, len(value)) + value
+    if isinstance(value, dict):
+        return head(5, len(value)) + b''.join(encode_cbor(key) + encode_cbor(item) for key, item in value.items())
+    # Plutus lists are indefinite length
+    return b'\x9f' + b''.join(encode_cbor(item) for item in value) + b'\xff'
+
+def random_address(rng, prefix='addr1q'):
+    return prefix + ''.join(rng.choice('023456789acdefghjklmnpqrstuvwxyz') for _ in range(52))
+
+def plutus_address(rng):
+    """A base address as Plutus data: key hash payment and stake credentials"""
+    return Constr(0, [Constr(0, [rng.randbytes(28)]), Constr(0, [Constr(0, [Constr(0, [rng.randbytes(28)])])])])
+
+def listing_datum(rng, price):
+    """jpg.store listing: lovelace payouts to the seller and the marketplace, and the seller's key hash.
+
+    The listed asset sits in the UTxO value, so its policy is not in the datum.
+    """
+    fee = max(1000000, price // 50)
+    return Constr(0, [
+        [Constr(0, [plutus_address(rng), price - fee]), Constr(0, [plutus_address(rng), fee])],
+        rng.randbytes(28),
+    ])
+
+def offer_datum(rng, policy, fee):
+    """jpg.store collection offer: the buyer is paid out one asset of the policy (a Value map), the marketplace its fee"""
+    return Constr(0, [
+        [Constr(0, [plutus_address(rng), {policy: {b'': 1}}]), Constr(0, [plutus_address(rng), fee])],
+        rng.randbytes(28),
+    ])
+
+class Dataset:
+    """db-sync shaped rows: block, tx, tx_out, tx_in, tx_metadata, datum, multi_asset and ma_tx_out"""
+
+    def __init__(self):
+        self.blocks = []       # (id, hash, block_no, time, epoch_no)
+        self.txs = []          # (id, hash, block_id)
+        self.tx_outs = []      # (id, tx_id, index, address, value, data_hash)
+        self.tx_ins = []       # (id, tx_in_id, tx_out_id, tx_out_index)
+        self.metadata = []     # (id, key, json, tx_id)
+        self.datums = {}       # hash -> bytes
+        self.multi_assets = [] # (id, policy, name)
+        self.ma_tx_outs = []   # (id, quantity, tx_out_id, ident)
+
+def generate(tx_count, seed=1):
+    """Generate tx_count transactions with jpg.store listing and offer patterns.
+
+    Returns the dataset, the watched wallets and the watched policy ids.
+    """
+    rng = random.Random(seed)
+    data = Dataset()
+    users = [random_address(rng) for _ in range(5000)]
+    wallets = [random_address(rng) for _ in range(2)]
+    contract = random_address(rng, 'addr1w')
+    watched_policies = [rng.randbytes(28) for _ in range(5)]
+    policies = watched_policies + [rng.randbytes(28) for _ in range(20)]
+    start = datetime(2024, 6, 1)
+
+    unspent = []           # Unrelated outputs, spent by unrelated traffic
+    wallet_unspent = {wallet: [] for wallet in wallets}
+    listings = []          # Listing outputs at the contract, with their policy
+    offers = []            # Offer outputs of the watched wallets at the contract, with their policy
+
+    def add_output(tx_id, index, address, value, data_hash=None):
+        data.tx_outs.append((len(data.tx_outs) + 1, tx_id, index, address, value, data_hash))
+        return (tx_id, index)
+
+    def hold_asset(ident):
+        # The output added last holds one unit of the asset
+        data.ma_tx_outs.append((len(data.ma_tx_outs) + 1, 1, len(data.tx_outs), ident))
+
+    def add_datum(value):
+        raw = encode_cbor(value)
+        datum_hash = hashlib.blake2b(raw, digest_size=32).digest()
+        data.datums[datum_hash] = raw
+        return datum_hash
+
+    def spend(tx_id, outputs):
+        for tx_out_id, tx_out_index in outputs:
+            data.tx_ins.append((len(data.tx_ins) + 1, tx_id, tx_out_id, tx_out_index))
+
+    for tx_id in range(1, tx_count + 1):
+        if (tx_id - 1) % TXS_PER_BLOCK == 0:
+            block_id = len(data.blocks) + 1
+            data.blocks.append((
+                block_id, hashlib.blake2b(b'block' + block_id.to_bytes(8, 'big'), digest_size=32).digest(), block_id,
+                start + timedelta(seconds=20 * block_id), 524 + block_id // BLOCKS_PER_EPOCH
+            ))
+        data.txs.append((tx_id, hashlib.blake2b(tx_id.to_bytes(8, 'big'), digest_size=32).digest(), block_id))
+
+        wallet = rng.choice(wallets)
+        draw = rng.random()
+        if tx_id < 50 or len(unspent) < 10:
+            # Genesis-like funding of users and wallets
+            address = wallets[tx_id % 2] if tx_id <= 10 else rng.choice(users)
+            output = add_output(tx_id, 0, address, rng.randint(50, 5000) * 1000000)
+            (wallet_unspent[address] if address in wallet_unspent else unspent).append(output)
+        elif draw < LISTING_SHARE:
+            # A seller locks an NFT at the contract with a listing datum
+            seller = rng.choice(users)
+            policy = rng.choice(policies)
+            datum_hash = add_datum(listing_datum(rng, rng.randint(5, 2000) * 1000000))
+            spend(tx_id, [unspent.pop(rng.randrange(len(unspent)))])
+            listing = add_output(tx_id, 0, contract, 2000000, datum_hash)
+            data.multi_assets.append((len(data.multi_assets) + 1, policy, f"Bench{tx_id}".encode()))
+            hold_asset(len(data.multi_assets))
+            listings.append((listing, len(data.multi_assets)))
+            unspent.append(add_output(tx_id, 1, seller, rng.randint(5, 500) * 1000000))
+        elif draw < LISTING_SHARE + OFFER_SHARE and wallet_unspent[wallet]:
+            # A watched wallet places a collection offer tagged with its policy,
+            # which the offer datum names as the asset to pay out
+            policy = rng.choice(policies)
+            spend(tx_id, [wallet_unspent[wallet].pop(0)])
+            offer = add_output(tx_id, 0, contract, rng.randint(10, 500) * 1000000, add_datum(offer_datum(rng, policy, 1000000)))
+            offers.append((offer, policy))
+            wallet_unspent[wallet].append(add_output(tx_id, 1, wallet, rng.randint(50, 5000) * 1000000))
+            data.metadata.append((len(data.metadata) + 1, 674, f"{policy.hex()}::offer", tx_id))
+        elif draw < LISTING_SHARE + OFFER_SHARE + OFFER_UPDATE_SHARE and wallet_unspent[wallet] and listings:
+            # The wallet spends a listing together with its own funds, no metadata,
+            # and receives the listed NFT
+            listing, ident = listings.pop(rng.randrange(len(listings)))
+            spend(tx_id, [wallet_unspent[wallet].pop(0), listing])
+            add_output(tx_id, 0, contract, rng.randint(10, 500) * 1000000)
+            wallet_unspent[wallet].append(add_output(tx_id, 1, wallet, rng.randint(50, 5000) * 1000000))
+            hold_asset(ident)
+        elif draw < LISTING_SHARE + OFFER_SHARE + OFFER_UPDATE_SHARE + OFFER_CHANGE_SHARE and wallet_unspent[wallet] and offers:
+            # The wallet changes the price of one of its offers without metadata:
+            # the spent offer datum is the only place its policy shows up
+            offer, policy = offers.pop(rng.randrange(len(offers)))
+            spend(tx_id, [wallet_unspent[wallet].pop(0), offer])
+            offer = add_output(tx_id, 0, contract, rng.randint(10, 500) * 1000000, add_datum(offer_datum(rng, policy, 1000000)))
+            offers.append((offer, policy))
+            wallet_unspent[wallet].append(add_output(tx_id, 1, wallet, rng.randint(50, 5000) * 1000000))
+        else:
+            # Unrelated traffic between users
+            spend(tx_id, [unspent.pop(rng.randrange(len(unspent))) for _ in range(min(len(unspent), rng.randint(1, 2)))])
+            for index in range(rng.randint(1, 3)):
+                unspent.append(add_output(tx_id, index, rng.choice(users), rng.randint(1, 1000) * 1000000))
+
+    return data, set(wallets), {policy.hex() for policy in watched_policies}
+
+class FakeDbSync:
+    """Answers the named poller queries from an in-memory Dataset, with the same row shapes"""
+
+    def __init__(self, data):
+        self.tx_hash = {tx_id: tx_hash.hex() for tx_id, tx_hash, _ in data.txs}
+        self.tx_block = {tx_id: block_id for tx_id, _, block_id in data.txs}
+        self.block_time = {block_id: block_time for block_id, _, _, block_time, _ in data.blocks}
+        self.block_hash = {block_id: block_hash.hex() for block_id, block_hash, _, _, _ in data.blocks}
+        self.tx_ids = [tx_id for tx_id, _, _ in data.txs]
+        self.outputs_by_tx = {}   # tx_id -> [tx_out key] in index order
+        self.out_rows = {}        # (tx_id, index) -> (address, value, data_hash)
+        self.by_address = {}      # address -> [tx_out key] in tx id order
+        for _, tx_id, index, address, value, data_hash in data.tx_outs:
+            self.outputs_by_tx.setdefault(tx_id, []).append((tx_id, index))
+            self.out_rows[(tx_id, index)] = (address, value, data_hash)
+            self.by_address.setdefault(address, []).append((tx_id, index))
+        self.inputs_by_tx = {}    # tx_id -> [tx_out key]
+        self.spent_by = {}        # tx_out key -> spending tx_id
+        for _, tx_in_id, tx_out_id, tx_out_index in data.tx_ins:
+            self.inputs_by_tx.setdefault(tx_in_id, []).append((tx_out_id, tx_out_index))
+            self.spent_by[(tx_out_id, tx_out_index)] = tx_in_id
+        asset_names = {ident: (policy.hex(), name.hex()) for ident, policy, name in data.multi_assets}
+        out_keys = {row_id: (tx_id, index) for row_id, tx_id, index, _, _, _ in data.tx_outs}
+        self.assets_by_out = {}   # tx_out key -> [(policy, name, quantity)] in hex
+        for _, quantity, tx_out_id, ident in data.ma_tx_outs:
+            self.assets_by_out.setdefault(out_keys[tx_out_id], []).append((*asset_names[ident], quantity))
+        self.metadata_by_tx = {}
+        for _, key, value, tx_id in data.metadata:
+            self.metadata_by_tx.setdefault(tx_id, []).append((key, value))
+        self.datum_bytes = data.datums
+
+    def execute(self, name, params):
+        return getattr(self, name)(*params)
+
+    def reset(self):
+        pass
+
+    def tip(self, max_tx_id, confirmations):
+        # block_no equals the block id in the synthetic chain
+        max_tx_id = min(max_tx_id, (len(self.block_time) - confirmations) * TXS_PER_BLOCK)
+        tx_id = self.tx_ids[bisect.bisect_right(self.tx_ids, max_tx_id) - 1]
+        block_id = self.tx_block[tx_id]
+        return [(block_id, tx_id, self.block_time[block_id], block_id, self.block_hash[block_id])]
+
+    def discovery(self, wallets, matched, low, high, policies):
+        # policies only feeds the optional discover_by_policy branch, not emulated here
+        hits = set()
+        for address in wallets:
+            for key in self.by_address.get(address, ()):
+                if low < key[0] <= high:
+                    hits.add(key[0])
+                spender = self.spent_by.get(key)
+                if spender is not None and low < spender <= high:
+                    hits.add(spender)
+        for address in matched:
+            for tx_id, _ in self.by_address.get(address, ()):
+                if low < tx_id <= high:
+                    hits.add(tx_id)
+        return [
+            (tx_id, self.tx_hash[tx_id], self.block_time[self.tx_block[tx_id]], self.tx_block[tx_id], self.block_hash[self.tx_block[tx_id]])
+            for tx_id in sorted(hits)
+        ]
+
+    def output_row(self, key):
+        address, value, data_hash = self.out_rows[key]
+        return key[0], key[1], address, value, data_hash.hex() if data_hash is not None else None
+
+    def inputs(self, tx_ids):
+        return [(tx_id, key[0], key[1], self.tx_hash[key[0]]) for tx_id in tx_ids for key in self.inputs_by_tx.get(tx_id, ())]
+
+    def utxos(self, tx_out_ids, tx_out_indexes):
+        return [self.output_row(key) for key in zip(tx_out_ids, tx_out_indexes) if key in self.out_rows]
+
+    def outputs(self, tx_ids):
+        return [self.output_row(key) for tx_id in tx_ids for key in self.outputs_by_tx.get(tx_id, ())]
+
+    def metadata(self, tx_ids):
+        return [(tx_id, key, value) for tx_id in tx_ids for key, value in self.metadata_by_tx.get(tx_id, ())]
+
+    def assets(self, tx_ids, policies):
+        policies = set(policies)
+        return [
+            (tx_id, spent, key[0], key[1], policy, name, quantity)
+            for tx_id in tx_ids
+            for spent, keys in ((True, self.inputs_by_tx.get(tx_id, ())), (False, self.outputs_by_tx.get(tx_id, ())))
+            for key in keys
+            for policy, name, quantity in self.assets_by_out.get(key, ())
+            if policy in policies
+        ]
+
+    def datums(self, data_hashes):
+        return [
+            (data_hash, self.datum_bytes[bytes.fromhex(data_hash)])
+            for data_hash in data_hashes
+            if bytes.fromhex(data_hash) in self.datum_bytes
+        ]
+
+def load_postgres(dsn, data):
+    """Load the dataset into a fresh bench schema; returns PgConnection params for it"""
+    import psycopg2
+    from psycopg2.extras import Json, execute_values
+
+    conn = psycopg2.connect(dsn)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE;")
+    cursor.execute(f"CREATE SCHEMA {BENCH_SCHEMA};")
+    cursor.execute(f"SET search_path TO {BENCH_SCHEMA};")
+    cursor.execute("""
+    CREATE TABLE block (id bigint PRIMARY KEY, hash bytea, block_no integer, time timestamp, epoch_no integer);
+    CREATE TABLE tx (id bigint PRIMARY KEY, hash bytea, block_id bigint);
+    CREATE TABLE tx_out (id bigint PRIMARY KEY, tx_id bigint, index smallint, address varchar,
+                         value numeric, data_hash bytea);
+    CREATE TABLE tx_in (id bigint PRIMARY KEY, tx_in_id bigint, tx_out_id bigint, tx_out_index smallint);
+    CREATE TABLE tx_metadata (id bigint PRIMARY KEY, key numeric, json jsonb, tx_id bigint);
+    CREATE TABLE datum (id bigserial PRIMARY KEY, hash bytea, bytes bytea);
+    CREATE TABLE multi_asset (id bigint PRIMARY KEY, policy bytea, name bytea);
+    CREATE TABLE ma_tx_out (id bigint PRIMARY KEY, quantity numeric, tx_out_id bigint, ident bigint);
+    """)
+    execute_values(cursor, "INSERT INTO block VALUES %s", data.blocks)
+    execute_values(cursor, "INSERT INTO tx VALUES %s", data.txs)
+    execute_values(cursor, "INSERT INTO tx_out VALUES %s", data.tx_outs)
+    execute_values(cursor, "INSERT INTO tx_in VALUES %s", data.tx_ins)
+    execute_values(cursor, "INSERT INTO tx_metadata VALUES %s",
+                   [(row_id, key, Json(value), tx_id) for row_id, key, value, tx_id in data.metadata])
+    execute_values(cursor, "INSERT INTO datum (hash, bytes) VALUES %s", list(data.datums.items()))
+    execute_values(cursor, "INSERT INTO multi_asset VALUES %s", data.multi_assets)
+    execute_values(cursor, "INSERT INTO ma_tx_out VALUES %s", data.ma_tx_outs)
+    cursor.execute("CREATE INDEX ON tx (block_id); CREATE INDEX ON tx_out (tx_id, index); CREATE INDEX ON datum (hash);"
+                   "CREATE INDEX ON block (hash); CREATE INDEX ON block (block_no);"
+                   "CREATE INDEX ON ma_tx_out (tx_out_id); CREATE INDEX ON ma_tx_out (ident); CREATE UNIQUE INDEX ON multi_asset (policy, name);")
+    find_txs.ensure_indexes(conn, False)
+    cursor.execute("ANALYZE;")
+    conn.close()
+    return {'dsn': dsn, 'options': f"-c search_path={BENCH_SCHEMA}"}
+
+class FakeTelegram(http.server.BaseHTTPRequestHandler):
+    """Accepts every sendMessage call"""
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b'{"ok": true, "result": {}}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class Timer:
+    """Latencies of one stage and the number of transactions it covered"""
+
+    def __init__(self):
+        self.latencies = []
+        self.txs = 0
+
+    def time(self, function, *args, txs=1):
+        started = time.perf_counter()
+        result = function(*args)
+        self.latencies.append(time.perf_counter() - started)
+        self.txs += txs
+        return result
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[round(fraction * (len(ordered) - 1))]
+
+def report(timers):
+    print(f"{'stage':<16}{'calls':>8}{'total s':>10}{'tx/s':>12}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, timer in timers.items():
+        if not timer.latencies:
+            print(f"{name:<16}{0:>8}")
+            continue
+        total = sum(timer.latencies)
+        print(
+            f"{name:<16}{len(timer.latencies):>8}{total:>10.3f}{timer.txs / total if total else 0:>12,.0f}"
+            f"{percentile(timer.latencies, 0.5) * 1000:>10.3f}{percentile(timer.latencies, 0.99) * 1000:>10.3f}"
+        )
+
+def run(tx_count, dsn=None, seed=1):
+    print(f"Generating {tx_count} synthetic transactions")
+    data, wallets, policies = generate(tx_count, seed)
+    pg = FakeDbSync(data) if dsn is None else find_txs.PgConnection(load_postgres(dsn, data))
+    print(f"{len(data.tx_outs)} outputs, {len(data.tx_ins)} inputs, {len(data.metadata)} metadata rows, {len(data.datums)} datums, {len(data.ma_tx_outs)} multi-asset outputs")
+
+    # Work in a scratch directory with its own settings files and database
+    os.chdir(tempfile.mkdtemp(prefix='jpg_sniper_bench_'))
+    os.makedirs('files')
+    for name, content in (('telegram.token', 'bench'), ('user.id', '1'),
+                          ('wallet.addr', '\n'.join(wallets)), ('policy.id', '\n'.join(policies))):
+        with open(os.path.join('files', name), 'w') as f:
+            f.write(content)
+    config = Config()
+
+    timers = {name: Timer() for name in ('discovery', 'enrichment', 'classification', 'persistence', 'formatting', 'telegram')}
+    sqlite_conn = storage.init_local_db()
+    datum_matcher = PolicyMatcher(policies)
+    find_txs.matched_addresses.clear()
+    window = 10000
+
+    for low in range(0, tx_count, window):
+        high = min(low + window, tx_count)
+        found = timers['discovery'].time(
+            pg.execute, 'discovery', (list(wallets), list(find_txs.matched_addresses), low, high, list(policies)), txs=high - low
+        )
+        for position in range(0, len(found), find_txs.batch_size):
+            batch = found[position:position + find_txs.batch_size]
+            details = timers['enrichment'].time(
+                find_txs.fetch_tx_details, pg, [row[0] for row in batch], wallets, policies, txs=len(batch)
+            )
+            writer = storage.TxWriter(sqlite_conn)
+            for tx_id, tx_hash, tx_date, block_no, block_hash in batch:
+                record = timers['classification'].time(
+                    find_txs.classify_transaction, tx_hash, tx_date, details[tx_id], wallets, policies, datum_matcher
+                )
+                if record is not None:
+                    record['block_no'], record['block_hash'] = block_no, block_hash
+                    find_txs.store_record(writer, record)
+            timers['persistence'].time(writer.flush, txs=len(writer.records))
+        if found:
+            find_txs.expire_matched_addresses(sqlite_conn, found[-1][2])
+            sqlite_conn.commit()
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeTelegram)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    tlg.CHAT_RATE_PER_SECOND = 1e9  # Measure the sender, not Telegram's rate limit
+    sender = tlg.TelegramSender('bench', api_url=f"http://127.0.0.1:{server.server_address[1]}")
+
+    alerts = storage.get_pending_alerts(storage.connect_reader(storage.DB_PATH))
+    for alert in alerts:
+        alert['target_ada_input'] = alert['target_lovelace_input'] / 1000000
+        alert['target_ada_output'] = alert['target_lovelace_output'] / 1000000
+        message = timers['formatting'].time(tlg.format_alert, alert, (), config.wallets)
+        # Send one by one so every call is timed, without coalescing
+        timers['telegram'].time(sender.send, config.chat_id, message)
+    server.shutdown()
+
+    print(f"{len(alerts)} alerts from {len(timers['classification'].latencies)} classified transactions")
+    hits, misses = (find_txs.utxo_lookups.values.get((('result', result),), 0) for result in ('hit', 'miss'))
+    print(f"{hits} of {hits + misses} spent outputs resolved from the UTxO cache")
+    matches = {labels[0][1]: count for labels, count in find_txs.tx_matched.values.items()}
+    print("Matches by path: " + ', '.join(f"{path} {matches.get(path, 0)}" for path in ('asset', 'metadata', 'datum')))
+    print(f"{len(datum_matcher.cache)} datums decoded for the datum path")
+    report(timers)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the poller and notifier on synthetic db-sync data")
+    parser.add_argument('--txs', type=int, default=100000, help="number of synthetic transactions")
+    parser.add_argument('--dsn', help="scratch PostgreSQL database to load the dataset into")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    run(args.txs, args.dsn, args.seed)
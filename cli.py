@@ -0,0 +1,139 @@
+"""Command line entry point for the poller, the backfill and the notifier.
+
+    python3 cli.py poll
+    python3 cli.py backfill --from-epoch 524 --workers 8
+    python3 cli.py notify
+    python3 cli.py query --policy <policy_id> --limit 50
+    python3 cli.py export --format jsonl --since 2024-06-01 > txs.jsonl
+    python3 cli.py api
+
+find_txs.py and tlg.py still run on their own, as poll and notify.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+import api
+import find_txs
+import storage
+import tlg
+from config import CONFIG_DIR, Config
+
+log = logging.getLogger('cli')
+
+# Settings each command cannot start without
+REQUIRED_SETTINGS = {
+    'poll': ('wallets', 'policies'),
+    'backfill': ('wallets', 'policies'),
+    'notify': ('bot_token', 'chat_id'),
+}
+
+# Commands that only read the local database and need no settings files
+LOCAL_COMMANDS = ('query', 'export', 'api')
+
+def add_filter_arguments(parser):
+    parser.add_argument('--db', default=storage.DB_PATH, help="local transaction database")
+    parser.add_argument('--wallet', help="watched wallet the transaction is tagged with")
+    parser.add_argument('--policy', help="matched policy id")
+    parser.add_argument('--tx-type', choices=['CREATION', 'INCREASE', 'DECREASE', 'DELETION', 'UNKNOWN'])
+    parser.add_argument('--address', help="address in any input or output")
+    parser.add_argument('--since', type=datetime.fromisoformat, help="first transaction date (ISO, UTC)")
+    parser.add_argument('--until', type=datetime.fromisoformat, help="transaction date to stop before (ISO, UTC)")
+
+def run_local_command(args):
+    """Run a query, export or api command against the local database"""
+    # Creates the schema and the query indexes if the poller has not yet
+    storage.init_local_db(args.db).close()
+    if args.command == 'api':
+        api.serve(args.db, args.port)
+        return
+    conn = storage.connect_reader(args.db)
+    filters = api.parse_filters(vars(args))
+    if args.command == 'query':
+        rows, cursor = api.query_page(conn, filters, args.limit, args.cursor)
+        json.dump({'txs': rows, 'next_cursor': cursor}, sys.stdout, indent=2, default=str)
+        sys.stdout.write('\n')
+    elif args.format == 'parquet':
+        if args.output is None:
+            raise SystemExit("--output is required for parquet exports")
+        api.write_parquet(conn, filters, args.output)
+    else:
+        write = api.write_csv if args.format == 'csv' else api.write_jsonl
+        if args.output is None:
+            write(conn, filters, sys.stdout)
+        else:
+            with open(args.output, 'w', newline='', encoding='utf-8') as out:
+                write(conn, filters, out)
+    conn.close()
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Find jpg.store transactions for watched wallets and policies and alert on Telegram")
+    parser.add_argument('--config-dir', default=CONFIG_DIR,
+                        help="directory of wallet.addr, policy.id, telegram.token, user.id and policy.routes")
+    parser.add_argument('--log-level', default=os.environ.get('LOG_LEVEL', 'INFO'), choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                        help="DEBUG prints every processed transaction and sent message")
+    parser.add_argument('--confirmations', type=int, default=find_txs.confirmations,
+                        help="blocks a transaction must be buried under before it is alerted, 0 for the tip")
+    parser.add_argument('--metrics-port', type=int,
+                        help=f"local port of the metrics endpoint, 0 to disable (default {find_txs.metrics_port} for poll, {tlg.METRICS_PORT} for notify)")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('poll', help="follow the chain tip and save matching transactions")
+    backfill_parser = subparsers.add_parser('backfill', help="scan history in parallel chunks")
+    backfill_parser.add_argument('--from-epoch', type=int, default=find_txs.epoch_threshold)
+    backfill_parser.add_argument('--workers', type=int, default=find_txs.backfill_workers)
+    backfill_parser.add_argument('--chunk-size', type=int, default=find_txs.backfill_chunk_size)
+    subparsers.add_parser('notify', help="send Telegram alerts for saved transactions")
+    query_parser = subparsers.add_parser('query', help="print one page of saved transactions as JSON, newest first")
+    add_filter_arguments(query_parser)
+    query_parser.add_argument('--limit', type=int, default=api.PAGE_SIZE)
+    query_parser.add_argument('--cursor', help="next_cursor of the previous page")
+    export_parser = subparsers.add_parser('export', help="stream saved transactions, oldest first")
+    add_filter_arguments(export_parser)
+    export_parser.add_argument('--format', choices=['csv', 'jsonl', 'parquet'], default='csv')
+    export_parser.add_argument('--output', help="file to write, standard output by default")
+    api_parser = subparsers.add_parser('api', help="serve queries and exports over HTTP on localhost")
+    api_parser.add_argument('--db', default=storage.DB_PATH, help="local transaction database")
+    api_parser.add_argument('--port', type=int, default=api.API_PORT)
+    return parser
+
+def main(argv=None, default_command='poll'):
+    parser = build_parser()
+    argv = sys.argv[1:] if argv is None else list(argv)
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(argv + [default_command])
+    # Queries and exports write their results to standard output
+    log_stream = sys.stderr if args.command in ('query', 'export') else sys.stdout
+    logging.basicConfig(stream=log_stream, level=args.log_level, format='%(asctime)s %(levelname)s %(message)s')
+    if args.command in LOCAL_COMMANDS:
+        try:
+            run_local_command(args)
+        except (RuntimeError, ValueError) as e:
+            # Missing optional dependency, or a bad --cursor
+            log.error(str(e))
+            sys.exit(1)
+        return
+
+    config = Config(args.config_dir)
+    missing = config.missing(*REQUIRED_SETTINGS[args.command])
+    if missing:
+        log.error(f"Required file not found or empty: {', '.join(missing)}")
+        sys.exit(1)
+
+    find_txs.confirmations = args.confirmations
+    if args.command == 'poll':
+        if args.metrics_port is not None:
+            find_txs.metrics_port = args.metrics_port or None
+        find_txs.poll(config)
+    elif args.command == 'backfill':
+        find_txs.backfill(config, args.from_epoch, args.workers, args.chunk_size)
+    else:
+        if args.metrics_port is not None:
+            tlg.METRICS_PORT = args.metrics_port or None
+        tlg.monitor_database(storage.DB_PATH, config)
+
+if __name__ == "__main__":
+    main()
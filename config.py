@@ -0,0 +1,87 @@
+import logging
+import os
+
+# Directory of the settings files, relative to the working directory
+CONFIG_DIR = 'files'
+
+log = logging.getLogger('config')
+
+def parse_watch_list(text):
+    """One wallet address or policy id per line, ignoring blanks and # comments"""
+    return frozenset(
+        line.split('#', 1)[0].strip()
+        for line in text.splitlines()
+        if line.split('#', 1)[0].strip()
+    )
+
+def parse_routes(text):
+    """One "<policy_id> <chat_id>" pair per line, ignoring # comments"""
+    routes = {}
+    for line in text.splitlines():
+        fields = line.split('#', 1)[0].split()
+        if len(fields) == 2:
+            routes[fields[0]] = fields[1]
+    return routes
+
+# Setting -> (file name, parser, value while the file is missing)
+SETTINGS = {
+    'wallets': ('wallet.addr', parse_watch_list, frozenset()),
+    'policies': ('policy.id', parse_watch_list, frozenset()),
+    'bot_token': ('telegram.token', str.strip, None),
+    'chat_id': ('user.id', str.strip, None),
+    'policy_routes': ('policy.routes', parse_routes, {}),
+}
+
+# Watch lists that keep their last value when the file is emptied or removed
+# while running, instead of silently watching nothing
+KEEP_WHEN_EMPTY = ('wallets', 'policies')
+
+class Config:
+    """Settings read from the files directory, reloaded when a file changes.
+
+    reload() costs one stat() per file, so it can run on every poll; a file is
+    only read and parsed again when its modification time or size changed.
+    Values are replaced, never mutated, so a reference taken at the start of a
+    pass stays consistent while the files are edited.
+    """
+
+    def __init__(self, directory=CONFIG_DIR):
+        self.directory = directory
+        self.stamps = {}
+        for name, (_, _, default) in SETTINGS.items():
+            setattr(self, name, default)
+        self.reload()
+
+    def path(self, name):
+        return os.path.join(self.directory, SETTINGS[name][0])
+
+    def reload(self):
+        """Re-read changed files; returns the names of the settings whose value changed"""
+        changed = []
+        for name, (_, parse, default) in SETTINGS.items():
+            path = self.path(name)
+            try:
+                stat = os.stat(path)
+                stamp = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                stamp = None
+            if name in self.stamps and stamp == self.stamps[name]:
+                continue
+            if stamp is None:
+                value = default
+            else:
+                with open(path, 'r') as file:
+                    value = parse(file.read())
+            self.stamps[name] = stamp
+            if not value and name in KEEP_WHEN_EMPTY and getattr(self, name):
+                log.warning(f"{path} is empty or missing, keeping the previous {len(getattr(self, name))} entries")
+                continue
+            if value != getattr(self, name):
+                setattr(self, name, value)
+                changed.append(name)
+                log.info(f"Loaded {path}" if stamp is not None else f"{path} was removed")
+        return changed
+
+    def missing(self, *names):
+        """Paths of the files behind the given settings that are missing or empty"""
+        return [self.path(name) for name in names if not getattr(self, name)]
@@ -0,0 +1,249 @@
+import re
+import struct
+from collections import OrderedDict, namedtuple
+
+# Plutus data constructor: Constr(index, fields)
+Constr = namedtuple('Constr', ['index', 'fields'])
+
+POLICY_ID_LENGTH = 28
+
+# Deepest nesting of arrays, maps and tags decoded; real datums stay far below
+# it, and deeper ones would exhaust the Python stack
+MAX_DEPTH = 64
+
+class CborError(ValueError):
+    pass
+
+def _freeze(value):
+    """Make decoded CBOR usable as a dict key"""
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, dict):
+        return tuple((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, Constr):
+        return Constr(value.index, _freeze(value.fields))
+    return value
+
+def _read_argument(data, offset, info):
+    """Read the length/value argument that follows an initial byte"""
+    if info < 24:
+        return info, offset
+    size = {24: 1, 25: 2, 26: 4, 27: 8}.get(info)
+    if size is None:
+        raise CborError(f"unsupported additional info {info}")
+    if offset + size > len(data):
+        raise CborError("truncated argument")
+    return int.from_bytes(data[offset:offset + size], 'big'), offset + size
+
+def _decode(data, offset, depth=0):
+    if depth > MAX_DEPTH:
+        raise CborError(f"nested deeper than {MAX_DEPTH} levels")
+    if offset >= len(data):
+        raise CborError("unexpected end of data")
+    initial = data[offset]
+    major, info = initial >> 5, initial & 0x1f
+    offset += 1
+
+    if info == 31 and major in (2, 3, 4, 5):
+        # Indefinite length: items until the 0xff break byte
+        items = []
+        while True:
+            if offset >= len(data):
+                raise CborError("missing break")
+            if data[offset] == 0xff:
+                offset += 1
+                break
+            item, offset = _decode(data, offset, depth + 1)
+            items.append(item)
+        if major == 2:
+            return b''.join(items), offset
+        if major == 3:
+            return ''.join(items), offset
+        if major == 4:
+            return items, offset
+        return {_freeze(key): value for key, value in zip(items[::2], items[1::2])}, offset
+
+    if major == 7:
+        if info == 20:
+            return False, offset
+        if info == 21:
+            return True, offset
+        if info in (22, 23):
+            return None, offset
+        formats = {25: ('>e', 2), 26: ('>f', 4), 27: ('>d', 8)}
+        if info in formats:
+            fmt, size = formats[info]
+            return struct.unpack(fmt, data[offset:offset + size])[0], offset + size
+        raise CborError(f"unsupported simple value {info}")
+
+    argument, offset = _read_argument(data, offset, info)
+
+    if major == 0:
+        return argument, offset
+    if major == 1:
+        return -1 - argument, offset
+    if major in (2, 3):
+        if offset + argument > len(data):
+            raise CborError("truncated string")
+        chunk = bytes(data[offset:offset + argument])
+        return (chunk if major == 2 else chunk.decode('utf-8')), offset + argument
+    if major == 4:
+        items = []
+        for _ in range(argument):
+            item, offset = _decode(data, offset, depth + 1)
+            items.append(item)
+        return items, offset
+    if major == 5:
+        result = {}
+        for _ in range(argument):
+            key, offset = _decode(data, offset, depth + 1)
+            value, offset = _decode(data, offset, depth + 1)
+            result[_freeze(key)] = value
+        return result, offset
+
+    # major 6: tagged value
+    value, offset = _decode(data, offset, depth + 1)
+    if 121 <= argument <= 127:
+        return Constr(argument - 121, value), offset
+    if 1280 <= argument <= 1400:
+        return Constr(argument - 1280 + 7, value), offset
+    if argument == 102:
+        return Constr(value[0], value[1]), offset
+    if argument == 2:
+        return int.from_bytes(value, 'big'), offset
+    if argument == 3:
+        return -1 - int.from_bytes(value, 'big'), offset
+    return value, offset
+
+def decode_cbor(data):
+    """Decode a single CBOR item, with Plutus constructor tags as Constr"""
+    value, offset = _decode(data, 0)
+    if offset != len(data):
+        raise CborError("trailing bytes")
+    return value
+
+def _hashes(value, found):
+    """Collect every 28-byte byte string (policy ids, key and script hashes)"""
+    if isinstance(value, bytes):
+        if len(value) == POLICY_ID_LENGTH:
+            found.add(value)
+    elif isinstance(value, Constr):
+        _hashes(value.fields, found)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _hashes(item, found)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            _hashes(key, found)
+            _hashes(item, found)
+    return found
+
+def _value_policies(amount):
+    """Policy ids of the assets in a payout amount given as a Value map"""
+    if not isinstance(amount, dict):
+        return set()
+    return {policy for policy in amount if isinstance(policy, bytes) and len(policy) == POLICY_ID_LENGTH}
+
+def _lovelace(amount):
+    """Lovelace of a payout amount given as an Int or as a Value map"""
+    if isinstance(amount, int):
+        return amount
+    if isinstance(amount, dict):
+        ada = amount.get(b'')
+        if isinstance(ada, dict) and isinstance(ada.get(b''), int):
+            return ada[b'']
+        return 0
+    return None
+
+def parse_listing(value):
+    """Extract the listing fields from a decoded jpg.store datum.
+
+    Listing datums are Constr 0 [payouts, owner] where every payout is
+    Constr 0 [address, amount], and amount is lovelace or a Value map
+    {policy: {name: quantity}}. Returns the policies of the assets paid out
+    (those an offer asks for), the total payout price in lovelace (None if
+    the datum is not a listing), the owner key hash, and every 28-byte field
+    of the datum, policy ids as well as key and script hashes.
+    """
+    listing = {'policies': frozenset(), 'price': None, 'owner': None, 'hashes': frozenset(_hashes(value, set()))}
+    if not (isinstance(value, Constr) and value.index == 0 and len(value.fields) == 2):
+        return listing
+    payouts, owner = value.fields
+    if not isinstance(payouts, list) or not isinstance(owner, bytes):
+        return listing
+
+    price = 0
+    policies = set()
+    for payout in payouts:
+        if not (isinstance(payout, Constr) and payout.index == 0 and len(payout.fields) == 2):
+            return listing
+        lovelace = _lovelace(payout.fields[1])
+        if lovelace is None:
+            return listing
+        price += lovelace
+        policies |= _value_policies(payout.fields[1])
+    listing['policies'] = frozenset(policies)
+    listing['price'] = price
+    listing['owner'] = owner.hex()
+    return listing
+
+class PolicyMatcher:
+    """Matches raw datum bytes against the watched policy ids.
+
+    A single regex alternation over all policy ids pre-filters datums in one
+    pass over the raw bytes. Hits are confirmed by decoding the CBOR: in a
+    listing datum only the policy of a paid out asset counts, so a payout
+    address whose script hash happens to be a watched id does not match; in
+    any other datum a whole 28-byte field does. Decoded datums are cached by
+    datum hash since the same listing datum is spent again and again.
+    """
+
+    def __init__(self, policy_ids=(), cache_size=10000):
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.policy_ids = None
+        self.set_policies(policy_ids)
+
+    def set_policies(self, policy_ids):
+        """Recompile the search pattern if the watched policies changed"""
+        policy_ids = frozenset(policy_ids)
+        if policy_ids == self.policy_ids:
+            return
+        self.policy_ids = policy_ids
+        self.policies = {bytes.fromhex(policy_id): policy_id for policy_id in policy_ids}
+        if self.policies:
+            self.pattern = re.compile(b'|'.join(re.escape(policy) for policy in sorted(self.policies)))
+        else:
+            self.pattern = None
+
+    def decode(self, datum_hash, raw):
+        """Decode a datum into its listing fields, or None if it is not valid CBOR"""
+        if datum_hash in self.cache:
+            self.cache.move_to_end(datum_hash)
+            return self.cache[datum_hash]
+        try:
+            listing = parse_listing(decode_cbor(raw))
+        except (CborError, IndexError, TypeError, ValueError, RecursionError, struct.error):
+            listing = None
+        self.cache[datum_hash] = listing
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return listing
+
+    def match(self, datum_hash, raw):
+        """Return (policy id hex, listing) for the first watched policy in the datum"""
+        if self.pattern is None:
+            return None, None
+        hit = self.pattern.search(raw)
+        if hit is None:
+            return None, None
+
+        listing = self.decode(datum_hash, raw)
+        if listing is None:
+            # Not CBOR: fall back to the byte-aligned raw hit
+            return self.policies[hit.group()], None
+        candidates = listing['policies'] if listing['price'] is not None else listing['hashes']
+        for policy in candidates:
+            if policy in self.policies:
+                return self.policies[policy], listing
+        return None, listing
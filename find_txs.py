@@ -1,18 +1,20 @@
+import logging
+import multiprocessing
+import os
 import psycopg2
-import sqlite3
+import heapq
+import re
+import select
+import socket
+import threading
 import time
-from datetime import datetime
-
-# Add this after the imports
-def adapt_datetime(dt):
-    return dt.isoformat()
-
-def convert_datetime(s):
-    return datetime.fromisoformat(s)
-
-# Register the adapter and converter
-sqlite3.register_adapter(datetime, adapt_datetime)
-sqlite3.register_converter("timestamp", convert_datetime)
+from contextlib import closing
+from datetime import datetime, timedelta, timezone
+from datum import PolicyMatcher
+from pipeline import OrderedStage, Persister
+from utxos import UtxoCache
+import metrics
+import storage
 
 # Database connection parameters
 db_params = {
@@ -26,385 +28,978 @@ db_params = {
 epoch_threshold = 524  # Starting epoch number if database does not exist
 
 # Add after database parameters
-matched_addresses = set()  # Store matched addresses globally
+matched_addresses = {}  # Active matched counterparty addresses -> last seen block time
+
+# Matched addresses expire after this many days (chain time) without being seen again,
+# and only the most recently seen matched_address_limit are kept and sent to discovery
+matched_address_ttl_days = 30
+matched_address_limit = 5000
+
+# Also discover transactions that move assets of the watched policies, whoever
+# the parties are; the address receiving the asset is then tagged as the target.
+# Off by default: only watched wallets and their counterparties are scanned.
+discover_by_policy = False
+
+# Resolved tx outputs kept in memory, so inputs spending outputs already fetched
+# (listings, offers, wallet change) are not joined against tx_out again.
+# With persist_utxo_cache they are saved with each checkpoint and reloaded on start.
+utxo_cache_size = 100000
+persist_utxo_cache = True
+utxo_cache = UtxoCache(utxo_cache_size)
+
+# Number of discovered transactions enriched per round of batched queries
+batch_size = 500
+
+# Enrichment threads (each with its own PostgreSQL connection) and the number of
+# batches allowed in flight between the pipeline stages
+enrich_workers = 4
+pipeline_depth = 4
+
+# Maximum number of tx ids scanned by one discovery pass while catching up
+scan_window = 200000
+
+# Backfill defaults: tx ids per resumable chunk and worker processes
+backfill_chunk_size = 100000
+backfill_workers = os.cpu_count() or 4
+
+# Channel fed by the trigger in sql/block_notify.sql
+notify_channel = 'jpg_sniper_block'
+
+# Adaptive polling bounds in seconds, used when the block trigger is not installed.
+# With the trigger, poll_interval_max is the safety re-check interval.
+poll_interval_min = 2
+poll_interval_max = 20
+
+# Local UDP port tlg.py listens on to be woken up after new alerts are committed
+alert_signal_port = 47831
+
+# Blocks a transaction must be buried under before it is processed and alerted.
+# 0 alerts at the tip; rolled back alerts are then retracted with a notice.
+confirmations = 0
+
+# Tip blocks remembered to find the fork point of a rollback
+# (Cardano never rolls back more than k = 2160 blocks)
+rollback_window = 2160
+
+# Local port of the Prometheus metrics endpoint of the poller (None disables it)
+metrics_port = 9108
+
+# Check for and create the recommended db-sync indexes on startup
+create_indexes = False
+
+# Recommended indexes as (table, leading columns) for each tx_out address layout
+recommended_indexes = {
+    False: [
+        ('tx_out', 'address, tx_id'),
+        ('tx_in', 'tx_in_id'),
+        ('tx_in', 'tx_out_id, tx_out_index'),
+        ('tx_metadata', 'tx_id'),
+    ],
+    True: [
+        ('address', 'address'),
+        ('tx_out', 'address_id, tx_id'),
+        ('tx_in', 'tx_in_id'),
+        ('tx_in', 'tx_out_id, tx_out_index'),
+        ('tx_metadata', 'tx_id'),
+    ],
+}
 
-def init_local_db():
-    """Initialize local SQLite database"""
-    conn = sqlite3.connect('local_transactions.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS tx (
-            tx_hash TEXT PRIMARY KEY,
-            tx_date TIMESTAMP,
-            metadata TEXT,
-            target_ada_input REAL,
-            target_ada_output REAL,
-            match_ada_input REAL,
-            match_ada_output REAL,
-            target_address TEXT,
-            matched_address TEXT,
-            inputs TEXT,     -- JSON string of inputs [{address, amount}, ...]
-            outputs TEXT,    -- JSON string of outputs [{address, amount}, ...]
-            tx_type TEXT     -- CREATION, INCREASE, DECREASE, or DELETION
-        )
-    ''')
-    
-    conn.commit()
-    return conn
-
-def get_latest_transaction_date(sqlite_conn):
-    """Get the latest transaction date from local SQLite database"""
-    cursor = sqlite_conn.cursor()
-    cursor.execute("SELECT MAX(tx_date) FROM tx")
-    result = cursor.fetchone()
-    return result[0] if result and result[0] else None
-
-def get_latest_processed_date():
-    """Get the latest processed date from a tracking file"""
+log = logging.getLogger('find_txs')
+
+query_seconds = metrics.Histogram('find_txs_query_seconds', "db-sync query latency by prepared statement")
+phase_seconds = metrics.Histogram('find_txs_phase_seconds', "Time spent per processing phase")
+tx_scanned = metrics.Counter('find_txs_tx_scanned_total', "Candidate transactions returned by discovery")
+tx_matched = metrics.Counter('find_txs_tx_matched_total', "Transactions matching a watched policy, by path")
+tx_saved = metrics.Counter('find_txs_tx_saved_total', "Matching transactions new to the local database")
+tx_skipped = metrics.Counter('find_txs_tx_skipped_total', "Candidate transactions skipped, by reason")
+tip_lag = metrics.Gauge('find_txs_tip_lag_seconds', "Wall clock time minus the block time of the last processed transaction")
+checkpoint_tx_id = metrics.Gauge('find_txs_checkpoint_tx_id', "db-sync tx id of the checkpoint")
+rollbacks = metrics.Counter('find_txs_rollbacks_total', "Chain rollbacks past the checkpoint")
+rolled_back_txs = metrics.Counter('find_txs_rolled_back_tx_total', "Saved transactions deleted by rollbacks")
+utxo_lookups = metrics.Counter('find_txs_utxo_lookups_total', "Spent outputs resolved by enrichment, by cache result")
+utxo_cache_entries = metrics.Gauge('find_txs_utxo_cache_entries', "Resolved outputs in the UTxO cache")
+
+def initial_checkpoint(pg_cursor, sqlite_conn):
+    """Derive a starting checkpoint from saved transactions or the epoch threshold"""
+    tx_hash = storage.get_latest_tx_hash(sqlite_conn)
+    if tx_hash:
+        pg_cursor.execute("SELECT tx.block_id, tx.id FROM tx WHERE tx.hash = decode(%s, 'hex');", (tx_hash,))
+        found = pg_cursor.fetchone()
+        if found:
+            log.info(f"Resuming after last saved transaction: {tx_hash}")
+            return (*found, None, None)
+
+    log.info(f"Starting from epoch threshold {epoch_threshold}")
+    return (*epoch_start(pg_cursor, epoch_threshold), None, None)
+
+def epoch_start(pg_cursor, epoch):
+    """Get the (block_id, tx_id) position just before the first transaction of an epoch"""
+    pg_cursor.execute("""
+    SELECT tx.block_id, tx.id - 1
+    FROM tx
+    WHERE tx.block_id >= (SELECT MIN(block.id) FROM block WHERE block.epoch_no >= %s)
+    ORDER BY tx.id ASC
+    LIMIT 1;
+    """, (epoch,))
+    return pg_cursor.fetchone()
+
+def summarize_amounts(record):
+    """Add the lovelace totals, tx type and counterparty list to a record before it is stored"""
+    target_address = record['target_address']
+    inputs, outputs = record['inputs'], record['outputs']
+    record['target_lovelace_input'] = sum(int(value) for _, _, addr, value in inputs if addr == target_address)
+    record['target_lovelace_output'] = sum(int(value) for addr, value in outputs if addr == target_address)
+    record['match_lovelace_input'] = sum(int(value) for _, _, addr, value in inputs if addr != target_address)
+    record['match_lovelace_output'] = sum(int(value) for addr, value in outputs if addr != target_address)
+    record['matched_address'] = ','.join(addr for addr, _ in outputs if addr != target_address)
+    record['tx_type'] = determine_tx_type(record['target_lovelace_input'], record['target_lovelace_output'])
+
+def load_matched_addresses(sqlite_conn):
+    """Load the most recently seen matched addresses into memory"""
+    matched_addresses.clear()
+    matched_addresses.update(storage.get_matched_addresses(sqlite_conn, matched_address_limit))
+
+def touch_matched_address(writer, address, seen):
+    """Record that a matched address was seen at block time seen"""
+    if address not in matched_addresses or matched_addresses[address] < seen:
+        matched_addresses[address] = seen
+    writer.touch(address, seen)
+
+def expire_matched_addresses(sqlite_conn, now):
+    """Drop matched addresses past the TTL and trim to the most recently seen limit"""
+    cutoff = now - timedelta(days=matched_address_ttl_days)
+    for address in [address for address, seen in matched_addresses.items() if seen < cutoff]:
+        del matched_addresses[address]
+
+    if len(matched_addresses) > matched_address_limit:
+        keep = heapq.nlargest(matched_address_limit, matched_addresses.items(), key=lambda item: item[1])
+        matched_addresses.clear()
+        matched_addresses.update(keep)
+    storage.delete_matched_addresses(sqlite_conn, cutoff, matched_address_limit)
+
+def signal_notifier():
+    """Wake tlg.py up after new alerts are committed (best effort)"""
     try:
-        with open('latest_processed_date.txt', 'r') as f:
-            date_str = f.read().strip()
-            return datetime.fromisoformat(date_str)
-    except:
-        return None
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(b'1', ('127.0.0.1', alert_signal_port))
+    except OSError:
+        pass
 
-def save_latest_processed_date(date):
-    """Save the latest processed date to a tracking file"""
-    if isinstance(date, datetime):
-        date_str = date.isoformat()
-    else:
-        date_str = date
-    with open('latest_processed_date.txt', 'w') as f:
-        f.write(date_str)
-
-def determine_tx_type(target_ada_input, target_ada_output):
+def determine_tx_type(target_input, target_output):
     """Determine transaction type based on wallet input/output values"""
-    if target_ada_input == 0 and target_ada_output > 0:
+    if target_input == 0 and target_output > 0:
         return "CREATION"
-    elif target_ada_input > 0 and target_ada_output == 0:
+    elif target_input > 0 and target_output == 0:
         return "DELETION"
-    elif target_ada_input > target_ada_output:
+    elif target_input > target_output:
         return "DECREASE"
-    elif target_ada_output > target_ada_input:
+    elif target_output > target_input:
         return "INCREASE"
     else:
         return "UNKNOWN"
 
-# Initial setup - before the loop
-sqlite_conn = init_local_db()
-latest_processed_date = None
+def uses_address_table(pg_cursor):
+    """Check whether db-sync stores tx_out addresses in the separate address table"""
+    pg_cursor.execute("""
+    SELECT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'tx_out' AND column_name = 'address_id'
+    );
+    """)
+    return pg_cursor.fetchone()[0]
+
+def build_queries(use_address_table, by_policy=False):
+    """Build the poller queries for the tx_out address layout as name -> (param types, sql)"""
+    def address_of(alias):
+        # Returns the join clause and address column for a tx_out alias
+        if use_address_table:
+            return f"JOIN address {alias}_address ON {alias}_address.id = {alias}.address_id", f"{alias}_address.address"
+        return "", f"{alias}.address"
+
+    source_join, source_address = address_of('source_tx_out')
+    out_join, out_address = address_of('tx_out')
+
+    # Watched policy ids, passed as hex
+    policy_filter = "multi_asset.policy = ANY(ARRAY(SELECT decode(policy, 'hex') FROM unnest({}::text[]) AS policy))"
+
+    policy_branch = ""
+    if by_policy:
+        policy_branch = f"""
+        UNION
+        -- assets of watched policies in outputs
+        SELECT tx_out.tx_id
+        FROM multi_asset
+        JOIN ma_tx_out ON ma_tx_out.ident = multi_asset.id
+        JOIN tx_out ON tx_out.id = ma_tx_out.tx_out_id
+        WHERE {policy_filter.format('$5')}
+        AND tx_out.tx_id > $3 AND tx_out.tx_id <= $4"""
+
+    # The output branches are range scans of the (address, tx_id) indexes.
+    # The outputs a watched wallet spent can be years old, so the input
+    # branch starts from the inputs in the new tx id range instead and looks
+    # their outputs up by (tx_id, index); MATERIALIZED keeps the planner from
+    # turning it back into a scan of every output the wallets ever received.
+    # UNION merges the branches on tx id
+    discovery = f"""
+    WITH new_tx_in AS MATERIALIZED (
+        SELECT tx_in.tx_in_id, tx_in.tx_out_id, tx_in.tx_out_index
+        FROM tx_in
+        WHERE tx_in.tx_in_id > $3 AND tx_in.tx_in_id <= $4
+    )
+    SELECT tx.id as tx_id, encode(tx.hash, 'hex') as tx_hash, block.time as tx_date,
+           block.block_no, encode(block.hash, 'hex') as block_hash
+    FROM (
+        -- watched wallets in inputs
+        SELECT new_tx_in.tx_in_id AS tx_id
+        FROM new_tx_in
+        JOIN tx_out source_tx_out ON source_tx_out.tx_id = new_tx_in.tx_out_id
+            AND source_tx_out.index = new_tx_in.tx_out_index
+        {source_join}
+        WHERE {source_address} = ANY($1)
+        UNION
+        -- watched wallets in outputs
+        SELECT tx_out.tx_id
+        FROM tx_out
+        {out_join}
+        WHERE {out_address} = ANY($1)
+        AND tx_out.tx_id > $3 AND tx_out.tx_id <= $4
+        UNION
+        -- matched addresses in outputs
+        SELECT tx_out.tx_id
+        FROM tx_out
+        {out_join}
+        WHERE {out_address} = ANY($2)
+        AND tx_out.tx_id > $3 AND tx_out.tx_id <= $4{policy_branch}
+    ) AS hit
+    JOIN tx ON tx.id = hit.tx_id
+    JOIN block ON block.id = tx.block_id
+    ORDER BY tx.id ASC;
+    """
+
+    # Spent output references only, with the hash of the tx that created them;
+    # the outputs come from the UTxO cache or utxos
+    inputs = """
+    SELECT tx_in.tx_in_id, tx_in.tx_out_id, tx_in.tx_out_index, encode(source_tx.hash, 'hex')
+    FROM tx_in
+    JOIN tx source_tx ON source_tx.id = tx_in.tx_out_id
+    WHERE tx_in.tx_in_id = ANY($1)
+    ORDER BY tx_in.tx_in_id, tx_in.id;
+    """
+
+    # Outputs by (tx id, index) pairs, passed as two parallel arrays
+    utxos = f"""
+    SELECT tx_out.tx_id, tx_out.index, {out_address}, tx_out.value, encode(tx_out.data_hash, 'hex')
+    FROM unnest($1::bigint[], $2::integer[]) AS ref (tx_id, index)
+    JOIN tx_out ON tx_out.tx_id = ref.tx_id AND tx_out.index = ref.index
+    {out_join};
+    """
+
+    outputs = f"""
+    SELECT tx_out.tx_id, tx_out.index, {out_address}, tx_out.value, encode(tx_out.data_hash, 'hex')
+    FROM tx_out
+    {out_join}
+    WHERE tx_out.tx_id = ANY($1)
+    ORDER BY tx_out.tx_id, tx_out.index;
+    """
+
+    metadata = """
+    SELECT tx_metadata.tx_id, tx_metadata.key, tx_metadata.json
+    FROM tx_metadata
+    WHERE tx_metadata.tx_id = ANY($1);
+    """
+
+    # Watched policy assets in the spent (true) and created (false) outputs of
+    # a batch, with the output they sit in
+    assets = f"""
+    SELECT tx_in.tx_in_id, true, tx_out.tx_id, tx_out.index,
+           encode(multi_asset.policy, 'hex'), encode(multi_asset.name, 'hex'), ma_tx_out.quantity
+    FROM tx_in
+    JOIN tx_out ON tx_out.tx_id = tx_in.tx_out_id AND tx_out.index = tx_in.tx_out_index
+    JOIN ma_tx_out ON ma_tx_out.tx_out_id = tx_out.id
+    JOIN multi_asset ON multi_asset.id = ma_tx_out.ident
+    WHERE tx_in.tx_in_id = ANY($1)
+    AND {policy_filter.format('$2')}
+    UNION ALL
+    SELECT tx_out.tx_id, false, tx_out.tx_id, tx_out.index,
+           encode(multi_asset.policy, 'hex'), encode(multi_asset.name, 'hex'), ma_tx_out.quantity
+    FROM tx_out
+    JOIN ma_tx_out ON ma_tx_out.tx_out_id = tx_out.id
+    JOIN multi_asset ON multi_asset.id = ma_tx_out.ident
+    WHERE tx_out.tx_id = ANY($1)
+    AND {policy_filter.format('$2')};
+    """
+
+    # Datums by the hex data hashes of the spent outputs
+    datums = """
+    SELECT encode(datum.hash, 'hex'), datum.bytes
+    FROM datum
+    WHERE datum.hash = ANY(ARRAY(SELECT decode(hash, 'hex') FROM unnest($1::text[]) AS hash));
+    """
+
+    # Last transaction up to a tx id in a block with at least $2 confirmations
+    tip = """
+    SELECT tx.block_id, tx.id, block.time, block.block_no, encode(block.hash, 'hex')
+    FROM tx
+    JOIN block ON block.id = tx.block_id
+    WHERE tx.id <= $1
+    AND block.block_no <= (SELECT MAX(block_no) FROM block) - $2
+    ORDER BY tx.id DESC
+    LIMIT 1;
+    """
+
+    block_hash = """
+    SELECT encode(block.hash, 'hex') FROM block WHERE block.id = $1;
+    """
+
+    # Which of the given block hashes db-sync still has
+    live_blocks = """
+    SELECT encode(block.hash, 'hex')
+    FROM block
+    WHERE block.hash = ANY(ARRAY(SELECT decode(hash, 'hex') FROM unnest($1::text[]) AS hash));
+    """
+
+    # Position after the last transaction at or below a block number
+    fork_point = """
+    SELECT tx.block_id, tx.id, block.block_no, encode(block.hash, 'hex')
+    FROM tx
+    JOIN block ON block.id = tx.block_id
+    WHERE block.block_no <= $1
+    ORDER BY tx.id DESC
+    LIMIT 1;
+    """
+
+    return {
+        'tip': ('bigint, bigint', tip),
+        'block_hash': ('bigint', block_hash),
+        'live_blocks': ('text[]', live_blocks),
+        'fork_point': ('bigint', fork_point),
+        'discovery': ('text[], text[], bigint, bigint, text[]', discovery),
+        'inputs': ('bigint[]', inputs),
+        'utxos': ('bigint[], integer[]', utxos),
+        'outputs': ('bigint[]', outputs),
+        'metadata': ('bigint[]', metadata),
+        'assets': ('bigint[], text[]', assets),
+        'datums': ('text[]', datums),
+    }
+
+class PgConnection:
+    """Long-lived PostgreSQL connection that runs the poller queries as prepared statements"""
+
+    def __init__(self, params):
+        self.params = params
+        self.conn = None
+        self.queries = None
+        self.prepared = set()
+
+    def cursor(self):
+        """Return a cursor, reconnecting if the connection was lost"""
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(**self.params)
+            # Polling is read-only; autocommit avoids idling in a transaction between polls
+            self.conn.autocommit = True
+            self.prepared = set()  # Prepared statements live and die with the session
+            if self.queries is None:
+                self.queries = build_queries(uses_address_table(self.conn.cursor()), discover_by_policy)
+        return self.conn.cursor()
+
+    def execute(self, name, params):
+        """Run a named query as a prepared statement and return all rows"""
+        pg_cursor = self.cursor()
+        with query_seconds.time(query=name):
+            if name not in self.prepared:
+                param_types, sql = self.queries[name]
+                pg_cursor.execute(f"PREPARE {name} ({param_types}) AS {sql.strip().rstrip(';')}")
+                self.prepared.add(name)
+            placeholders = ', '.join(['%s'] * len(params))
+            pg_cursor.execute(f"EXECUTE {name} ({placeholders})", params)
+            rows = pg_cursor.fetchall()
+        pg_cursor.close()
+        return rows
+
+    def reset(self):
+        """Drop the connection so the next use reconnects"""
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+        self.conn = None
+
+class BlockListener:
+    """Waits for new db-sync blocks via LISTEN/NOTIFY, or adaptive polling without the trigger"""
+
+    def __init__(self, params, channel):
+        self.params = params
+        self.channel = channel
+        self.conn = None
+        self.interval = poll_interval_min
+
+    def listen(self):
+        """Open the listening connection if the block trigger is installed"""
+        conn = psycopg2.connect(**self.params)
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'jpg_sniper_block_notify');")
+        if cursor.fetchone()[0]:
+            cursor.execute(f"LISTEN {self.channel};")
+            self.conn = conn
+            log.info(f"Listening for new blocks on channel {self.channel}")
+        else:
+            conn.close()
+            log.info("Block trigger not installed (see sql/block_notify.sql), using adaptive polling")
+
+    def wait(self, chain_advanced):
+        """Block until a new block is announced or the polling interval passes"""
+        if self.conn is None:
+            # Poll quickly while the chain moves, back off while it is idle
+            if chain_advanced:
+                self.interval = poll_interval_min
+            else:
+                self.interval = min(self.interval * 2, poll_interval_max)
+            time.sleep(self.interval)
+            return
+
+        try:
+            if select.select([self.conn], [], [], poll_interval_max) != ([], [], []):
+                # Several blocks may have landed; one discovery pass covers them all
+                self.conn.poll()
+                self.conn.notifies.clear()
+        except (psycopg2.Error, OSError) as e:
+            log.warning(f"Block listener error: {e}, falling back to polling")
+            self.close()
+            time.sleep(poll_interval_min)
+
+    def close(self):
+        """Close the listening connection"""
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except psycopg2.Error:
+                pass
+        self.conn = None
+
+def ensure_indexes(pg_conn, use_address_table):
+    """Create the recommended db-sync indexes that are missing"""
+    pg_conn.autocommit = True  # CREATE INDEX CONCURRENTLY cannot run in a transaction
+    pg_cursor = pg_conn.cursor()
+    for table, columns in recommended_indexes[use_address_table]:
+        pg_cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = %s;", (table,))
+        # Any existing index with the same leading columns is good enough
+        existing = [re.search(r'\((.*)\)', row[0]).group(1) for row in pg_cursor.fetchall()]
+        if any(definition.startswith(columns) for definition in existing):
+            continue
+        index_name = f"idx_jpg_sniper_{table}_{columns.replace(', ', '_')}"
+        log.info(f"Creating index {index_name} on {table} ({columns}), this may take a while")
+        pg_cursor.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index_name} ON {table} ({columns});")
+    pg_cursor.close()
+
+# PostgreSQL connections of the enrichment threads, one per thread
+enrich_local = threading.local()
+enrich_connections = []
+
+def enrich_connection():
+    """Get the calling enrichment thread's own PostgreSQL connection"""
+    if not hasattr(enrich_local, 'pg'):
+        enrich_local.pg = PgConnection(db_params)
+        enrich_connections.append(enrich_local.pg)
+    return enrich_local.pg
+
+def fetch_tx_details(pg, tx_ids, target_addresses, target_policyids):
+    """Fetch inputs, outputs, metadata, watched assets and datums for a batch of tx ids"""
+    details = {
+        tx_id: {'inputs': [], 'spent': [], 'outputs': [], 'metadata': [], 'assets': [], 'datums': []}
+        for tx_id in tx_ids
+    }
+
+    # Get all outputs for the batch; later candidates often spend them
+    fetched = []
+    for tx_id, index, address, value, data_hash in pg.execute('outputs', (tx_ids,)):
+        details[tx_id]['outputs'].append((address, value))
+        fetched.append(((tx_id, index), (address, value, data_hash)))
+    utxo_cache.put_many(fetched)
+    addresses = {ref: output[0] for ref, output in fetched}
+
+    # Resolve the outputs spent by the batch, from the cache where possible
+    spent = pg.execute('inputs', (tx_ids,))
+    resolved, missing = utxo_cache.get_many([(tx_out_id, tx_out_index) for _, tx_out_id, tx_out_index, _ in spent])
+    utxo_lookups.inc(len(resolved), result='hit')
+    if missing:
+        utxo_lookups.inc(len(missing), result='miss')
+        fetched = [
+            ((tx_out_id, tx_out_index), (address, value, data_hash))
+            for tx_out_id, tx_out_index, address, value, data_hash
+            in pg.execute('utxos', ([ref[0] for ref in missing], [ref[1] for ref in missing]))
+        ]
+        utxo_cache.put_many(fetched)
+        resolved.update(fetched)
+    data_hashes = {tx_id: [] for tx_id in tx_ids}
+    for tx_id, tx_out_id, tx_out_index, source_hash in spent:
+        output = resolved.get((tx_out_id, tx_out_index))
+        if output is None:
+            continue
+        address, value, data_hash = output
+        details[tx_id]['inputs'].append((tx_out_id, tx_out_index, address, value))
+        # (tx hash, output index) of each input, in the same order
+        details[tx_id]['spent'].append((source_hash, tx_out_index))
+        addresses[(tx_out_id, tx_out_index)] = address
+        if data_hash is not None:
+            data_hashes[tx_id].append(data_hash)
+
+    # Watched policy assets moved by each tx: the net quantity each address
+    # received, so assets only passing through change outputs cancel out
+    if target_policyids:
+        received = {tx_id: {} for tx_id in tx_ids}
+        for tx_id, spent_output, tx_out_id, tx_out_index, policy_id, asset_name, quantity in pg.execute('assets', (tx_ids, list(target_policyids))):
+            address = addresses.get((tx_out_id, tx_out_index))
+            if address is None:
+                continue
+            key = (address, policy_id, asset_name)
+            received[tx_id][key] = received[tx_id].get(key, 0) + (-int(quantity) if spent_output else int(quantity))
+        for tx_id, net in received.items():
+            details[tx_id]['assets'] = [
+                (address, policy_id, asset_name, quantity)
+                for (address, policy_id, asset_name), quantity in sorted(net.items())
+                if quantity > 0
+            ]
+
+    # Fetch metadata for the batch
+    for tx_id, key, json_data in pg.execute('metadata', (tx_ids,)):
+        details[tx_id]['metadata'].append((key, json_data))
+
+    # Datums are only needed by the fallback check, which requires the
+    # wallet address in the inputs
+    datum_tx_ids = [
+        tx_id for tx_id in tx_ids
+        if any(addr in target_addresses for _, _, addr, _ in details[tx_id]['inputs'])
+    ]
+    wanted = {data_hash for tx_id in datum_tx_ids for data_hash in data_hashes[tx_id]}
+    if wanted:
+        datum_bytes = {data_hash: bytes(raw) for data_hash, raw in pg.execute('datums', (list(wanted),))}
+        for tx_id in datum_tx_ids:
+            for data_hash in data_hashes[tx_id]:
+                if data_hash in datum_bytes:
+                    details[tx_id]['datums'].append((bytes.fromhex(data_hash), datum_bytes[data_hash]))
+
+    return details
+
+def classify_transaction(tx_hash, tx_date, details, target_addresses, target_policyids, datum_matcher):
+    """Decide whether an enriched transaction belongs to a watched policy.
+
+    Returns the record to save, including the counterparty addresses to keep
+    in the matched address window, or None if the transaction is skipped.
+    """
+    inputs = details['inputs']
+    outputs = details['outputs']
+
+    # Tag the tx with the first watched wallet it touches
+    target_address = next(
+        (addr for _, _, addr, _ in inputs if addr in target_addresses),
+        next((addr for addr, _ in outputs if addr in target_addresses), None)
+    )
+
+    # Formatting every input and output is only worth it when it is shown
+    if log.isEnabledFor(logging.DEBUG):
+        # Print all inputs together
+        log.debug("Inputs:")
+        for _, _, addr, value in inputs:
+            ada_value = float(value) / 1000000.0
+            if addr == target_address:
+                log.debug(f"  → {ada_value:,.6f} ADA from $me")
+            else:
+                truncated_addr = f"{addr[:4]}...{addr[-7:]}"
+                log.debug(f"  → {ada_value:,.6f} ADA from {truncated_addr}")
+
+        # Print all outputs together
+        log.debug("Outputs:")
+        for addr, value in outputs:
+            ada_value = float(value) / 1000000.0
+            if addr == target_address:
+                log.debug(f"  ← {ada_value:,.6f} ADA to $me")
+            else:
+                truncated_addr = f"{addr[:7]}...{addr[-7:]}"
+                log.debug(f"  ← {ada_value:,.6f} ADA to {truncated_addr}")
+
+    metadata_result = details['metadata']
+    
+    # Process metadata
+    cleaned_policyid = None
+    metadata = {}
+    if metadata_result:
+        for key, json_data in metadata_result:
+            metadata[key] = json_data
+            if isinstance(json_data, str) and '::' in str(json_data):
+                try:
+                    parts = str(json_data).split('::')
+                    if len(parts) > 1:
+                        cleaned_policyid = parts[0].strip('"')
+                except Exception as e:
+                    log.warning(f"Error processing metadata: {e}")
+
+    log.debug("Metadata found: %s", bool(metadata_result))
+    log.debug("Cleaned Policy ID: %s", cleaned_policyid)
+    log.debug("Watched policy IDs: %d", len(target_policyids))
+
+    record = {
+        'tx_hash': tx_hash,
+        'tx_date': tx_date,
+        'metadata': metadata,
+        'inputs': inputs,
+        'spent': details['spent'],
+        'outputs': outputs,
+        'target_address': target_address,
+        'assets': [asset for asset in details['assets'] if asset[1] in target_policyids],
+    }
+
+    # Exact match: an asset of a watched policy changed hands
+    if record['assets'] and (target_address is not None or discover_by_policy):
+        log.debug("✓ Watched asset moved: %s.%s", record['assets'][0][1], record['assets'][0][2])
+        tx_matched.inc(path='asset')
+        record['policy_id'] = record['assets'][0][1]
+        if target_address is None:
+            # Found by policy alone: follow the address that received the asset,
+            # and keep its unrelated counterparties out of the discovery window
+            record['target_address'] = record['assets'][0][0]
+            record['matched_addresses'] = []
+        else:
+            record['matched_addresses'] = (
+                [addr for _, _, addr, _ in inputs if addr not in target_addresses] +
+                [addr for addr, _ in outputs if addr not in target_addresses]
+            )
+        return record
+
+    # Save to database only if policy ID matches
+    if cleaned_policyid in target_policyids:
+        log.debug("✓ Policy ID matches! Saving transaction data")
+        tx_matched.inc(path='metadata')
+        record['policy_id'] = cleaned_policyid
+        # Add all counterparties to our tracking window
+        record['matched_addresses'] = (
+            [addr for _, _, addr, _ in inputs if addr not in target_addresses] +
+            [addr for addr, _ in outputs if addr not in target_addresses]
+        )
+        log.debug("Added matched addresses: %s", record['matched_addresses'])
+        return record
+
+    # Check if metadata contains policy ID format
+    has_policy_format = False
+    if metadata_result:
+        for key, json_data in metadata_result:
+            if isinstance(json_data, str) and '::' in str(json_data):
+                has_policy_format = True
+                break
+    
+    if has_policy_format:
+        log.debug("✗ Transaction has policy ID format but doesn't match target - skipping")
+        tx_skipped.inc(reason='policy_mismatch')
+        return None
 
-# Check if we have any transactions in the SQLite database
-sqlite_cursor = sqlite_conn.cursor()
-sqlite_cursor.execute("SELECT MAX(tx_date) FROM tx")
-db_latest_date = sqlite_cursor.fetchone()[0]
+    # Check if wallet address is in inputs AND matched address is in outputs
+    has_wallet_in_inputs = any(addr in target_addresses for _, _, addr, _ in inputs)
+    has_matched_in_outputs = any(addr in matched_addresses for addr, _ in outputs)
+    
+    if not (has_wallet_in_inputs and has_matched_in_outputs):
+        log.debug("✗ No policy ID format and no matching pattern - skipping transaction")
+        tx_skipped.inc(reason='no_pattern')
+        return None
 
-if db_latest_date:
-    latest_processed_date = db_latest_date
-    print(f"Resuming from last saved transaction date: {latest_processed_date}")
-else:
-    print("No transactions in database, starting from epoch threshold")
+    # Datums were fetched with the batch
+    datum_policyid = None
+    for datum_hash, datum_bytes in details['datums']:
+        datum_policyid, listing = datum_matcher.match(datum_hash, datum_bytes)
+        if datum_policyid:
+            log.debug("✓ Found policy ID in transaction datum! Saving transaction data")
+            if listing and listing['price'] is not None:
+                log.debug("Listing price: %.6f ADA", listing['price'] / 1000000.0)
+            break
+    
+    if not datum_policyid:
+        log.debug("✗ Related transaction found but policy ID not in datum - skipping")
+        tx_skipped.inc(reason='no_datum_match')
+        return None
 
-while True:
-    try:
-        # Read target address and policy ID
-        with open('files/wallet.addr', 'r') as file:
-            target_address = file.read().strip()
-            # print(f"\nTarget address: {target_address}")
-        with open('files/policy.id', 'r') as file:
-            target_policyid = file.read().strip()
-            # print(f"Target policy ID: {target_policyid}")
-        
-        # Connect to PostgreSQL
-        pg_conn = psycopg2.connect(**db_params)
-        pg_cursor = pg_conn.cursor()
-
-        # Check if we have any transactions in the SQLite database
-        sqlite_cursor = sqlite_conn.cursor()
-        sqlite_cursor.execute("SELECT COUNT(*) FROM tx")
-        has_records = sqlite_cursor.fetchone()[0] > 0
-
-        if not has_records and latest_processed_date is None:
-            query = """
-            SELECT DISTINCT encode(tx.hash, 'hex') as tx_hash, block.time as tx_date
-            FROM tx_out
-            JOIN tx ON tx.id = tx_out.tx_id
-            JOIN block ON block.id = tx.block_id
-            JOIN tx_in ON tx_in.tx_in_id = tx.id
-            JOIN tx_out source_tx_out ON tx_in.tx_out_id = source_tx_out.tx_id 
-                AND tx_in.tx_out_index = source_tx_out.index
-            WHERE (
-                (source_tx_out.address = %s)  -- wallet address in inputs
-                OR 
-                (tx_out.address = %s)  -- wallet address in outputs
-                OR 
-                (tx_out.address = ANY(%s))  -- matched addresses in outputs
-            )
-            AND block.epoch_no >= %s
-            ORDER BY block.time ASC;
-            """
-            pg_cursor.execute(query, (target_address, target_address, list(matched_addresses), epoch_threshold))
-        else:
-            query = """
-            SELECT DISTINCT encode(tx.hash, 'hex') as tx_hash, block.time as tx_date
-            FROM tx_out
-            JOIN tx ON tx.id = tx_out.tx_id
-            JOIN block ON block.id = tx.block_id
-            JOIN tx_in ON tx_in.tx_in_id = tx.id
-            JOIN tx_out source_tx_out ON tx_in.tx_out_id = source_tx_out.tx_id 
-                AND tx_in.tx_out_index = source_tx_out.index
-            WHERE (
-                (source_tx_out.address = %s)  -- wallet address in inputs
-                OR 
-                (tx_out.address = %s)  -- wallet address in outputs
-                OR 
-                (tx_out.address = ANY(%s))  -- matched addresses in outputs
-            )
-            AND block.time > %s
-            ORDER BY block.time ASC;
-            """
-            pg_cursor.execute(query, (target_address, target_address, list(matched_addresses), latest_processed_date))
-
-        # Process new transactions
-        new_transactions = pg_cursor.fetchall()
-        # print(f"Found {len(new_transactions)} new transactions")
-        
-        if new_transactions:
-            # Update the latest date we've seen
-            latest_processed_date = new_transactions[-1][1]
-            print(f"Updated latest processed date to: {latest_processed_date}")
-            
+    tx_matched.inc(path='datum')
+
+    record['policy_id'] = datum_policyid
+    # Keep the matched addresses that led here in the window
+    record['matched_addresses'] = [addr for addr, _ in outputs if addr in matched_addresses]
+    return record
+
+def check_rollback(pg, sqlite_conn, checkpoint):
+    """Undo saved transactions of blocks db-sync rolled back past the checkpoint.
+
+    Costs one block lookup per pass while the checkpoint block is unchanged.
+    Returns the checkpoint to resume from.
+    """
+    block_id, tx_id, block_no, block_hash = checkpoint
+    if block_hash is None:
+        return checkpoint
+    rows = pg.execute('block_hash', (block_id,))
+    if rows and rows[0][0] == block_hash:
+        return checkpoint
+
+    # Fork point: the newest remembered tip block db-sync still has
+    recent = storage.get_recent_blocks(sqlite_conn)
+    live = {row[0] for row in pg.execute('live_blocks', ([recent_hash for _, recent_hash in recent],))}
+    fork_block_no = next((recent_no for recent_no, recent_hash in recent if recent_hash in live), block_no - rollback_window)
+
+    saved_hashes = storage.get_block_hashes_after(sqlite_conn, fork_block_no)
+    live = {row[0] for row in pg.execute('live_blocks', (saved_hashes,))}
+    deleted = storage.delete_rolled_back(sqlite_conn, fork_block_no, [saved_hash for saved_hash in saved_hashes if saved_hash not in live])
+
+    checkpoint = pg.execute('fork_point', (fork_block_no,))[0]
+    storage.save_checkpoint(sqlite_conn, *checkpoint, keep_blocks=rollback_window)
+    # db-sync reuses the tx ids of rolled back blocks
+    utxo_cache.discard_after(checkpoint[1])
+    storage.delete_cached_utxos_after(sqlite_conn, checkpoint[1])
+    sqlite_conn.commit()
+    rollbacks.inc()
+    rolled_back_txs.inc(len(deleted))
+    log.warning(f"Chain rolled back to block {fork_block_no}, deleted {len(deleted)} saved transactions")
+    if deleted:
+        signal_notifier()
+    return checkpoint
+
+def enrich_batch(batch, target_addresses, target_policyids):
+    """Fetch the details of a discovered batch on the calling enrichment thread"""
+    with phase_seconds.time(phase='enrich'):
+        return batch, fetch_tx_details(enrich_connection(), [row[0] for row in batch], target_addresses, target_policyids)
+
+def flush_batch(writer):
+    """Write a classified batch; returns the number of new transactions"""
+    with phase_seconds.time(phase='commit'):
+        return writer.flush()
+
+def store_record(writer, record, alert=True):
+    """Buffer a classified record and refresh its matched addresses"""
+    summarize_amounts(record)
+    writer.add(record, alert=alert)
+    for addr in record['matched_addresses']:
+        touch_matched_address(writer, addr, record['tx_date'])
+
+def poll(config):
+    """Follow the chain tip and save matching transactions.
+
+    Each pass runs as a pipeline: discovery on this thread, enrichment of the
+    next batches on enrich_workers threads, classification on this thread in
+    chain order, and persistence on a writer thread. Bounded queues between
+    the stages keep at most pipeline_depth batches in memory. The watch
+    lists are reloaded between passes when their files change.
+    """
+    if metrics_port is not None:
+        metrics.serve(metrics_port)
+    sqlite_conn = storage.init_local_db()
+    enricher = OrderedStage(enrich_workers, pipeline_depth, 'enrich')
+    persister = Persister(pipeline_depth)
+    persister.start()
+    checkpoint = storage.get_checkpoint(sqlite_conn)
+    load_matched_addresses(sqlite_conn)
+    log.info(f"Loaded {len(matched_addresses)} matched addresses")
+    if persist_utxo_cache:
+        utxo_cache.put_many(storage.get_cached_utxos(sqlite_conn, utxo_cache_size), persist=False)
+        log.info(f"Loaded {len(utxo_cache)} cached outputs")
+    datum_matcher = PolicyMatcher(config.policies)
+    pg = PgConnection(db_params)
+    listener = BlockListener(db_params, notify_channel)
+    listener_checked = False
+
+    if create_indexes:
+        index_conn = psycopg2.connect(**db_params)
+        ensure_indexes(index_conn, uses_address_table(index_conn.cursor()))
+        index_conn.close()
+
+    if checkpoint:
+        log.info(f"Resuming from checkpoint block {checkpoint[0]} / tx {checkpoint[1]}")
+
+    def abort_pass():
+        """Drop partial work so the pass is redone from the last checkpoint"""
+        persister.wait(raise_error=False)
+        sqlite_conn.rollback()
+        load_matched_addresses(sqlite_conn)
+        # Outputs fetched past the checkpoint are not covered by rollback detection yet
+        if checkpoint is not None:
+            utxo_cache.discard_after(checkpoint[1])
+
+    while True:
+        try:
+            # Pick up edited watch lists; derived structures are only rebuilt on change
+            if 'policies' in config.reload():
+                datum_matcher.set_policies(config.policies)
+            target_addresses = config.wallets
+            target_policyids = config.policies
+
+            # Subscribe before the first pass so no block announcement is missed
+            if not listener_checked:
+                listener.listen()
+                listener_checked = True
+
+            if checkpoint is None:
+                checkpoint = initial_checkpoint(pg.cursor(), sqlite_conn)
+            checkpoint = check_rollback(pg, sqlite_conn, checkpoint)
+            last_tx_id = checkpoint[1]
+
+            # Upper bound of this pass: the confirmed chain tip, capped while catching up
+            tip_block_id, tip_tx_id, tip_time, tip_block_no, tip_block_hash = pg.execute('tip', (last_tx_id + scan_window, confirmations))[0]
+            caught_up = tip_tx_id < last_tx_id + scan_window
+
+            # Process new transactions
+            new_transactions = pg.execute('discovery', (list(target_addresses), list(matched_addresses), last_tx_id, tip_tx_id, list(target_policyids)))
+            # print(f"Found {len(new_transactions)} new transactions")
+            tx_scanned.inc(len(new_transactions))
             transactions_saved = 0
             
-            for row in new_transactions:
-                tx_hash, tx_date = row
-                print(f"\n---Processing transaction: {tx_hash} / {tx_date}")
-
-                # Get all inputs for this transaction
-                inputs_query = """
-                SELECT tx_in.tx_out_id, tx_in.tx_out_index, tx_out.address, tx_out.value
-                FROM tx_in
-                INNER JOIN tx_out ON tx_in.tx_out_id = tx_out.tx_id AND tx_in.tx_out_index = tx_out.index
-                INNER JOIN tx ON tx.id = tx_in.tx_in_id
-                WHERE tx.hash = decode(%s, 'hex');
-                """
-                pg_cursor.execute(inputs_query, (tx_hash,))
-                inputs = pg_cursor.fetchall()
-
-                # Get all outputs for this transaction
-                outputs_query = """
-                SELECT tx_out.address, tx_out.value
-                FROM tx_out
-                INNER JOIN tx ON tx_out.tx_id = tx.id
-                WHERE tx.hash = decode(%s, 'hex');
-                """
-                pg_cursor.execute(outputs_query, (tx_hash,))
-                outputs = pg_cursor.fetchall()
-
-                # Print all inputs together
-                print("\nInputs:")
-                for _, _, addr, value in inputs:
-                    ada_value = float(value) / 1000000.0
-                    if addr == target_address:
-                        print(f"  → {ada_value:,.6f} ADA from $me")
-                    else:
-                        truncated_addr = f"{addr[:4]}...{addr[-7:]}"
-                        print(f"  → {ada_value:,.6f} ADA from {truncated_addr}")
-
-                # Print all outputs together
-                print("\nOutputs:")
-                for addr, value in outputs:
-                    ada_value = float(value) / 1000000.0
-                    if addr == target_address:
-                        print(f"  ← {ada_value:,.6f} ADA to $me")
-                    else:
-                        truncated_addr = f"{addr[:7]}...{addr[-7:]}"
-                        print(f"  ← {ada_value:,.6f} ADA to {truncated_addr}")
-
-                # Calculate totals for database storage (since schema remains unchanged)
-                target_ada_input = sum(float(value) / 1000000.0 for _, _, addr, value in inputs if addr == target_address)
-                target_ada_output = sum(float(value) / 1000000.0 for addr, value in outputs if addr == target_address)
-                match_ada_input = sum(float(value) / 1000000.0 for _, _, addr, value in inputs if addr != target_address)
-                match_ada_output = sum(float(value) / 1000000.0 for addr, value in outputs if addr != target_address)
-
-                # Fetch metadata
-                metadata_query = """
-                SELECT key, json
-                FROM tx_metadata
-                JOIN tx ON tx.id = tx_metadata.tx_id
-                WHERE tx.hash = decode(%s, 'hex');
-                """
-                pg_cursor.execute(metadata_query, (tx_hash,))
-                metadata_result = pg_cursor.fetchall()
-                
-                # Process metadata
-                cleaned_policyid = None
-                metadata = {}
-                if metadata_result:
-                    for key, json_data in metadata_result:
-                        metadata[key] = json_data
-                        if isinstance(json_data, str) and '::' in str(json_data):
-                            try:
-                                parts = str(json_data).split('::')
-                                if len(parts) > 1:
-                                    cleaned_policyid = parts[0].strip('"')
-                            except Exception as e:
-                                print(f"Error processing metadata: {e}")
-
-                print(f"Metadata found: {bool(metadata_result)}")
-                print(f"Cleaned Policy ID: {cleaned_policyid}")
-                print(f"Target Policy ID: {target_policyid}")
-                
-                # Save to database only if policy ID matches
-                if cleaned_policyid == target_policyid:
-                    try:
-                        # Add matched addresses to our tracking set
-                        for _, _, addr, _ in inputs:
-                            if addr != target_address:
-                                matched_addresses.add(addr)
-                        for addr, _ in outputs:
-                            if addr != target_address:
-                                matched_addresses.add(addr)
-                                
-                        # Format inputs and outputs as JSON strings
-                        inputs_json = [
-                            {
-                                "address": addr,
-                                "amount": float(value) / 1000000.0
-                            }
-                            for _, _, addr, value in inputs
-                        ]
-                        
-                        outputs_json = [
-                            {
-                                "address": addr,
-                                "amount": float(value) / 1000000.0
-                            }
-                            for addr, value in outputs
-                        ]
-
-                        # Add tx_type determination before the INSERT
-                        tx_type = determine_tx_type(target_ada_input, target_ada_output)
-
-                        sqlite_cursor.execute(
-                            """INSERT INTO tx (
-                                tx_hash, tx_date, metadata,
-                                target_ada_input, target_ada_output,
-                                match_ada_input, match_ada_output,
-                                target_address, matched_address,
-                                inputs, outputs, tx_type
-                            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                            (tx_hash, tx_date, str(metadata),
-                             target_ada_input, target_ada_output,
-                             match_ada_input, match_ada_output,
-                             target_address, ','.join(addr for addr, _ in outputs if addr != target_address),
-                             str(inputs_json), str(outputs_json), tx_type)
-                        )
-                        transactions_saved += 1
-                        print(f"✓ Policy ID matches! Saving transaction data")
-                        print(f"Added matched addresses: {[addr for addr, _ in outputs if addr != target_address]}")
-                    except sqlite3.Error as e:
-                        print(f"SQLite error: {e}")
-                else:
-                    # Check if metadata contains policy ID format
-                    has_policy_format = False
-                    if metadata_result:
-                        for key, json_data in metadata_result:
-                            if isinstance(json_data, str) and '::' in str(json_data):
-                                has_policy_format = True
-                                break
-                    
-                    if has_policy_format:
-                        print(f"✗ Transaction has policy ID format but doesn't match target - skipping")
-                    else:
-                        # Check if wallet address is in inputs AND matched address is in outputs
-                        has_wallet_in_inputs = any(addr == target_address for _, _, addr, _ in inputs)
-                        has_matched_in_outputs = any(addr in matched_addresses for addr, _ in outputs)
-                        
-                        if has_wallet_in_inputs and has_matched_in_outputs:
-                            # Check datum for policy ID before saving
-                            datum_query = """
-                            SELECT encode(d.bytes, 'hex') as datum_bytes
-                            FROM tx
-                            JOIN tx_in ON tx_in.tx_in_id = tx.id
-                            JOIN tx_out source_tx_out ON tx_in.tx_out_id = source_tx_out.tx_id 
-                                AND tx_in.tx_out_index = source_tx_out.index
-                            JOIN datum d ON d.hash = source_tx_out.data_hash
-                            WHERE tx.hash = decode(%s, 'hex')
-                            """
-                            
-                            pg_cursor.execute(datum_query, (tx_hash,))
-                            datum_results = pg_cursor.fetchall()
-                            
-                            found_in_datum = False
-                            if datum_results:
-                                for datum_row in datum_results:
-                                    datum_bytes = datum_row[0]
-                                    if target_policyid in datum_bytes:
-                                        found_in_datum = True
-                                        print(f"✓ Found policy ID in transaction datum! Saving transaction data")
-                                        break
-                            
-                            if found_in_datum:
-                                try:
-                                    # Format inputs and outputs as JSON strings
-                                    inputs_json = [
-                                        {
-                                            "address": addr,
-                                            "amount": float(value) / 1000000.0
-                                        }
-                                        for _, _, addr, value in inputs
-                                    ]
-                                    
-                                    outputs_json = [
-                                        {
-                                            "address": addr,
-                                            "amount": float(value) / 1000000.0
-                                        }
-                                        for addr, value in outputs
-                                    ]
-
-                                    # Add tx_type determination before the INSERT
-                                    tx_type = determine_tx_type(target_ada_input, target_ada_output)
-
-                                    sqlite_cursor.execute(
-                                        """INSERT INTO tx (
-                                            tx_hash, tx_date, metadata,
-                                            target_ada_input, target_ada_output,
-                                            match_ada_input, match_ada_output,
-                                            target_address, matched_address,
-                                            inputs, outputs, tx_type
-                                        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                                        (tx_hash, tx_date, str(metadata),
-                                         target_ada_input, target_ada_output,
-                                         match_ada_input, match_ada_output,
-                                         target_address, ','.join(addr for addr, _ in outputs if addr != target_address),
-                                         str(inputs_json), str(outputs_json), tx_type)
-                                    )
-                                    transactions_saved += 1
-                                except sqlite3.Error as e:
-                                    print(f"SQLite error: {e}")
-                            else:
-                                print(f"✗ Related transaction found but policy ID not in datum - skipping")
-                        else:
-                            print(f"✗ No policy ID format and no matching pattern - skipping transaction")
-
-            sqlite_conn.commit()
-            print(f"\nProcessed up to date: {latest_processed_date}")
-            print(f"Saved {transactions_saved} matching transactions out of {len(new_transactions)} total transactions")
-
-        # else:
-        #     print("No new transactions found")
-            
-        # Clean up connections
-        pg_cursor.close()
-        pg_conn.close()
-
-        time.sleep(10)
-
-    except Exception as e:
-        print(f"Error: {e}")
-        time.sleep(1)
+            if new_transactions:
+                # Enrich each batch in a few set-based queries, ahead of classification
+                batches = [new_transactions[position:position + batch_size] for position in range(0, len(new_transactions), batch_size)]
+                # Closed before abort_pass on a failed pass, once the running
+                # enrichments are done, so none of them refills utxo_cache after
+                # the discard
+                with closing(enricher.map(lambda batch: enrich_batch(batch, target_addresses, target_policyids), batches)) as enriched:
+                    for batch, tx_details in enriched:
+                        writer = storage.TxWriter(sqlite_conn)
+                        for tx_id, tx_hash, tx_date, block_no, block_hash in batch:
+                            log.debug("---Processing transaction: %s / %s", tx_hash, tx_date)
+
+                            with phase_seconds.time(phase='classify'):
+                                record = classify_transaction(tx_hash, tx_date, tx_details[tx_id], target_addresses, target_policyids, datum_matcher)
+                            if record is None:
+                                continue
+                            record['block_no'], record['block_hash'] = block_no, block_hash
+                            store_record(writer, record)
+                        # Write the batch in one transaction on the writer thread
+                        persister.submit(lambda writer=writer: flush_batch(writer))
+                transactions_saved = persister.wait()
+                tx_saved.inc(transactions_saved)
+
+                expire_matched_addresses(sqlite_conn, new_transactions[-1][2])
+
+                log.info(f"Processed up to block {tip_block_id} / tx {tip_tx_id}")
+                log.info(f"Saved {transactions_saved} matching transactions out of {len(new_transactions)} total transactions")
+
+            # else:
+            #     print("No new transactions found")
+
+            # Batches are upserted and only alerted when new, so a pass interrupted
+            # before its checkpoint is simply redone; the checkpoint commits last
+            if tip_tx_id > last_tx_id:
+                checkpoint = (tip_block_id, tip_tx_id, tip_block_no, tip_block_hash)
+                storage.save_checkpoint(sqlite_conn, *checkpoint, keep_blocks=rollback_window)
+            if persist_utxo_cache:
+                storage.save_cached_utxos(sqlite_conn, utxo_cache.take_new(), utxo_cache_size)
+            utxo_cache_entries.set(len(utxo_cache))
+            with phase_seconds.time(phase='commit'):
+                sqlite_conn.commit()
+            checkpoint_tx_id.set(tip_tx_id)
+            # db-sync block times are UTC
+            tip_lag.set((datetime.now(timezone.utc).replace(tzinfo=None) - tip_time).total_seconds())
+
+            if transactions_saved:
+                signal_notifier()
+
+            if caught_up:
+                listener.wait(tip_tx_id > last_tx_id)
+
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            log.error(f"PostgreSQL connection error: {e}, reconnecting")
+            pg.reset()
+            for enrich_pg in enrich_connections:
+                enrich_pg.reset()
+            listener.close()
+            listener_checked = False
+            abort_pass()
+            time.sleep(1)
+
+        except Exception as e:
+            log.exception(f"Error: {e}")
+            abort_pass()
+            time.sleep(1)
+
+# Per-process state of backfill workers, set by init_backfill_worker
+worker_state = {}
+
+def init_backfill_worker(target_addresses, target_policyids, matched_snapshot):
+    """Give each backfill worker its own PostgreSQL connection and watch lists"""
+    log.setLevel(logging.WARNING)  # Per-tx output from parallel workers is unreadable
+    matched_addresses.clear()
+    matched_addresses.update(matched_snapshot)
+    worker_state['pg'] = PgConnection(db_params)
+    worker_state['target_addresses'] = target_addresses
+    worker_state['target_policyids'] = target_policyids
+    worker_state['datum_matcher'] = PolicyMatcher(target_policyids)
+
+def backfill_chunk(chunk):
+    """Discover, enrich and classify one tx id range; returns (chunk, records)"""
+    start_tx_id, end_tx_id = chunk
+    pg = worker_state['pg']
+    target_addresses = worker_state['target_addresses']
+    target_policyids = worker_state['target_policyids']
+
+    new_transactions = pg.execute('discovery', (list(target_addresses), list(matched_addresses), start_tx_id, end_tx_id, list(target_policyids)))
+    records = []
+    for position in range(0, len(new_transactions), batch_size):
+        batch = new_transactions[position:position + batch_size]
+        tx_details = fetch_tx_details(pg, [row[0] for row in batch], target_addresses, target_policyids)
+        for tx_id, tx_hash, tx_date, block_no, block_hash in batch:
+            record = classify_transaction(tx_hash, tx_date, tx_details[tx_id], target_addresses, target_policyids, worker_state['datum_matcher'])
+            if record is not None:
+                record['block_no'], record['block_hash'] = block_no, block_hash
+                records.append(record)
+                # Later txs in this chunk see the new counterparties, as in poll()
+                for addr in record['matched_addresses']:
+                    matched_addresses[addr] = tx_date
+    return chunk, records
+
+def backfill(config, from_epoch, workers, chunk_size):
+    """Scan history from an epoch in parallel tx id chunks, resumable per chunk.
+
+    Workers only see the matched addresses known when the backfill starts,
+    since chunks run out of order. Backfilled transactions are not alerted.
+    """
+    sqlite_conn = storage.init_local_db()
+    sqlite_cursor = sqlite_conn.cursor()
+    writer = storage.TxWriter(sqlite_conn)
+    load_matched_addresses(sqlite_conn)
+    target_addresses = config.wallets
+    target_policyids = config.policies
+
+    pg = PgConnection(db_params)
+    _, start_tx_id = epoch_start(pg.cursor(), from_epoch)
+    # Stop where the poller took over, or at the tip if it never ran
+    checkpoint = storage.get_checkpoint(sqlite_conn)
+    end_tx_id = checkpoint[1] if checkpoint else pg.execute('tip', (2 ** 62, confirmations))[0][1]
+    pg.reset()
+
+    sqlite_cursor.executemany(
+        "INSERT OR IGNORE INTO backfill_chunk (start_tx_id, end_tx_id) VALUES (?, ?)",
+        [(start, min(start + chunk_size, end_tx_id)) for start in range(start_tx_id, end_tx_id, chunk_size)]
+    )
+    sqlite_conn.commit()
+    sqlite_cursor.execute(
+        """SELECT start_tx_id, end_tx_id FROM backfill_chunk
+        WHERE done_at IS NULL AND start_tx_id >= ? AND end_tx_id <= ?
+        ORDER BY start_tx_id""",
+        (start_tx_id, end_tx_id)
+    )
+    pending = sqlite_cursor.fetchall()
+    log.info(f"Backfilling tx {start_tx_id}..{end_tx_id}: {len(pending)} chunks pending on {workers} workers")
+
+    with multiprocessing.Pool(
+        workers,
+        initializer=init_backfill_worker,
+        initargs=(target_addresses, target_policyids, dict(matched_addresses))
+    ) as pool:
+        # Single writer: each chunk's rows and its done mark are committed together
+        for done, ((chunk_start, chunk_end), records) in enumerate(pool.imap_unordered(backfill_chunk, pending), 1):
+            for record in records:
+                store_record(writer, record, alert=False)
+            sqlite_cursor.execute(
+                "UPDATE backfill_chunk SET done_at = ? WHERE start_tx_id = ? AND end_tx_id = ?",
+                (datetime.now(), chunk_start, chunk_end)
+            )
+            saved = writer.flush()
+            log.info(f"[{done}/{len(pending)}] tx {chunk_start}..{chunk_end}: saved {saved} of {len(records)} matches")
 
+    sqlite_conn.close()
 
+if __name__ == "__main__":
+    import cli
+    cli.main(default_command='poll')
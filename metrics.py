@@ -0,0 +1,126 @@
+import http.server
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Latency buckets in seconds, from a single SQLite insert to a slow catch-up query
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+# Name -> metric; a module run as a script and imported again registers its metrics
+# twice, and the copy imported last is the one in use
+_registry = {}
+_lock = threading.Lock()
+
+log = logging.getLogger('metrics')
+
+def _label_text(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+class Metric:
+    """A named metric with one value per label set"""
+
+    kind = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        with _lock:
+            _registry[name] = self
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_label_text(labels)} {value}")
+        return lines
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with _lock:
+            self.values[tuple(sorted(labels.items()))] = value
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of the with block"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            for labels, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_label_text(labels + (('le', bound),))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{_label_text(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{_label_text(labels)} {total}")
+                lines.append(f"{self.name}_count{_label_text(labels)} {count}")
+        return lines
+
+def render():
+    """All registered metrics in the Prometheus text exposition format"""
+    with _lock:
+        metrics = list(_registry.values())
+    return '\n'.join(line for metric in metrics for line in metric.render()) + '\n'
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port):
+    """Serve /metrics on localhost in a background thread.
+
+    Returns the server, or None if the port cannot be bound (e.g. another
+    instance holds it); metrics are optional, so that is only a warning.
+    """
+    try:
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    except OSError as e:
+        log.warning(f"Metrics endpoint unavailable on port {port} ({e}), continuing without it")
+        return None
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log.info(f"Serving metrics on http://127.0.0.1:{server.server_address[1]}/metrics")
+    return server
@@ -0,0 +1,107 @@
+import heapq
+from collections import namedtuple
+
+# A live offer: the contract output holding it and its price in lovelace
+Offer = namedtuple('Offer', ['tx_hash', 'position', 'price', 'previous_price'])
+
+def percent_change(old, new):
+    return (new - old) / old * 100 if old else 0.0
+
+class OfferBook:
+    """Live offers keyed by (policy id, owner address) and by contract UTxO.
+
+    Each transaction replaces the owner's offer on its policy, so an update
+    is a couple of dict operations. The best offer per policy comes from a
+    max-heap whose stale entries are dropped lazily when they reach the top.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.offers = {}    # (policy_id, owner) -> Offer
+        self.by_utxo = {}   # (tx_hash, position) -> (policy_id, owner)
+        self.heaps = {}     # policy_id -> [(-price, tx_hash, owner)]
+
+    def rebuild(self, history):
+        """Replay saved transactions, oldest first"""
+        self.clear()
+        for tx in history:
+            self.apply(tx)
+
+    def best(self, policy_id):
+        """Return (price, owner) of the best offer on a policy, or None"""
+        heap = self.heaps.get(policy_id)
+        while heap:
+            negative_price, tx_hash, owner = heap[0]
+            offer = self.offers.get((policy_id, owner))
+            if offer is not None and offer.tx_hash == tx_hash:
+                return -negative_price, owner
+            heapq.heappop(heap)
+        return None
+
+    def apply(self, tx):
+        """Update the book with a saved transaction and describe what it changed.
+
+        tx needs tx_hash, policy_id, owner, offer_position, spent and
+        target_lovelace_output, as returned by storage.get_pending_alerts.
+        Offers held in the outputs the transaction spends are retired first,
+        whoever signed it: the owner withdrawing or updating, or a seller
+        accepting the offer. Returns a dict with the owner's previous price and
+        the policy's best offer before and after, or None if the transaction
+        was already applied.
+        """
+        policy_id, owner = tx['policy_id'], tx['owner']
+        key = (policy_id, owner)
+        current = self.offers.get(key)
+        if current is not None and current.tx_hash == tx['tx_hash']:
+            return None
+
+        best_before = self.best(policy_id)
+        for ref in tx.get('spent', ()):
+            spent_key = self.by_utxo.pop(ref, None)
+            if spent_key is not None:
+                self.offers.pop(spent_key, None)
+        if current is not None:
+            self.by_utxo.pop((current.tx_hash, current.position), None)
+
+        price = tx['target_lovelace_output'] or 0
+        if price and tx['offer_position'] is not None:
+            offer = Offer(tx['tx_hash'], tx['offer_position'], price, current.price if current else None)
+            self.offers[key] = offer
+            self.by_utxo[(offer.tx_hash, offer.position)] = key
+            heapq.heappush(self.heaps.setdefault(policy_id, []), (-price, offer.tx_hash, owner))
+        else:
+            # Offer withdrawn
+            self.offers.pop(key, None)
+
+        return {
+            'previous_price': current.price if current else None,
+            'price': price,
+            'best_before': best_before,
+            'best_after': self.best(policy_id),
+        }
+
+    def describe(self, change):
+        """Human readable lines for a change returned by apply()"""
+        if change is None:
+            return []
+        lines = []
+        price, previous = change['price'], change['previous_price']
+        if previous and price:
+            lines.append(f"Previous offer {previous / 1000000:,.2f} ADA ({percent_change(previous, price):+.1f}%)")
+
+        best_before, best_after = change['best_before'], change['best_after']
+        before = best_before[0] if best_before else 0
+        after = best_after[0] if best_after else 0
+        if after > before and best_after[0] == price:
+            if before:
+                lines.append(f"🔥 New best offer (+{percent_change(before, after):.1f}% over {before / 1000000:,.2f} ADA)")
+            else:
+                lines.append("🔥 New best offer on this policy")
+        elif before and after < before:
+            if after:
+                lines.append(f"📉 Best offer dropped {-percent_change(before, after):.1f}% to {after / 1000000:,.2f} ADA")
+            else:
+                lines.append("📉 No offers left on this policy")
+        return lines
@@ -0,0 +1,74 @@
+import collections
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+class OrderedStage:
+    """Runs an I/O bound function over items on a thread pool, yielding results in input order.
+
+    At most depth items are running or waiting to be consumed, so a slow
+    consumer holds the workers back instead of a whole catch-up piling up in
+    memory, while the next items are already being fetched.
+    """
+
+    def __init__(self, workers, depth, name):
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix=name)
+        self.depth = depth
+
+    def map(self, function, items):
+        """Yield function(item) for each item; close() the generator to abandon it.
+
+        Closing returns once no call is left running, so nothing the workers
+        do lands after the caller has cleaned up.
+        """
+        in_flight = collections.deque()
+        try:
+            for item in items:
+                in_flight.append(self.executor.submit(function, item))
+                if len(in_flight) >= self.depth:
+                    yield in_flight.popleft().result()
+            while in_flight:
+                yield in_flight.popleft().result()
+        finally:
+            # Abandoned early (error in the consumer): skip what has not started
+            # and let the running calls finish
+            for future in in_flight:
+                future.cancel()
+            wait(in_flight)
+
+class Persister(threading.Thread):
+    """Single writer thread that runs queued write jobs in submission order.
+
+    submit() blocks while depth jobs are waiting, which holds classification
+    back when the disk is the bottleneck. After a failed job the remaining jobs
+    are skipped and wait() re-raises the error in the caller.
+    """
+
+    def __init__(self, depth):
+        super().__init__(daemon=True)
+        self.jobs = queue.Queue(depth)
+        self.total = 0
+        self.error = None
+
+    def submit(self, job):
+        self.jobs.put(job)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if self.error is None:
+                    self.total += job() or 0
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def wait(self, raise_error=True):
+        """Wait for every submitted job; returns the sum of their results since the last wait"""
+        self.jobs.join()
+        total, self.total = self.total, 0
+        error, self.error = self.error, None
+        if error is not None and raise_error:
+            raise error
+        return total
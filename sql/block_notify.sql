@@ -0,0 +1,18 @@
+-- Announce new db-sync blocks to find_txs.py over LISTEN/NOTIFY.
+-- Install on the cexplorer database:
+--   psql -d cexplorer -f sql/block_notify.sql
+-- Notifications are delivered when db-sync commits the block, so its
+-- transactions are already visible to the poller.
+
+CREATE OR REPLACE FUNCTION jpg_sniper_notify_block() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('jpg_sniper_block', NEW.id::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS jpg_sniper_block_notify ON block;
+
+CREATE TRIGGER jpg_sniper_block_notify
+    AFTER INSERT ON block
+    FOR EACH ROW EXECUTE FUNCTION jpg_sniper_notify_block();
@@ -0,0 +1,652 @@
+import ast
+import json
+import logging
+import re
+import sqlite3
+from datetime import datetime
+
+DB_PATH = 'local_transactions.db'
+
+log = logging.getLogger('storage')
+
+def adapt_datetime(dt):
+    return dt.isoformat()
+
+def convert_datetime(s):
+    return datetime.fromisoformat(s)
+
+# Register the adapter and converter
+sqlite3.register_adapter(datetime, adapt_datetime)
+sqlite3.register_converter("timestamp", convert_datetime)
+
+def connect(db_path=DB_PATH):
+    """Open a writer connection in WAL mode, so readers and the writer never block each other"""
+    # The poller hands the connection to its writer thread; it is never used concurrently
+    conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    # Durable at checkpoints; a power loss can only drop the last commits, never corrupt
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+def connect_reader(db_path=DB_PATH):
+    """Open a long-lived read-only connection; each query sees the latest commit"""
+    return sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+
+def init_local_db(db_path=DB_PATH):
+    """Initialize local SQLite database and return a writer connection"""
+    conn = connect(db_path)
+    cursor = conn.cursor()
+
+    migrate_legacy_tx_table(conn)
+    create_tx_tables(cursor)
+
+    # Databases created before multi-policy watching lack the policy tag,
+    # and those created before rollback handling lack the block position
+    add_missing_columns(cursor, 'tx', [('policy_id', 'TEXT'), ('block_no', 'INTEGER'), ('block_hash', 'TEXT')])
+    # and inputs saved before offer tracking lack the output they spend
+    add_missing_columns(cursor, 'tx_io', [('spent_tx_hash', 'TEXT'), ('spent_index', 'INTEGER')])
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tx_block_no ON tx (block_no)
+    ''')
+
+    # Indexes of the api.py filters; each ends with (tx_date, tx_hash), the page order
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tx_date ON tx (tx_date, tx_hash)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tx_policy_date ON tx (policy_id, tx_date, tx_hash)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tx_type_date ON tx (tx_type, tx_date, tx_hash)
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tx_target_date ON tx (target_address, tx_date, tx_hash)
+    ''')
+
+    # Pending Telegram alerts, written in the same transaction as the tx row
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tx_hash TEXT NOT NULL,
+            created_at TIMESTAMP,
+            sent_at TIMESTAMP,
+            kind TEXT NOT NULL DEFAULT 'alert',  -- 'alert', or 'rollback' to retract a sent alert
+            policy_id TEXT,                       -- policy of a rollback notice, whose tx row is gone
+            taken_at TIMESTAMP                    -- handed to the Telegram sender by tlg.py
+        )
+    ''')
+    add_missing_columns(cursor, 'outbox', [
+        ('kind', "TEXT NOT NULL DEFAULT 'alert'"),
+        ('policy_id', 'TEXT'),
+        ('taken_at', 'TIMESTAMP'),
+    ])
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (id) WHERE sent_at IS NULL
+    ''')
+
+    # Counterparty addresses of matching txs, watched as discovery outputs
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS matched_address (
+            address TEXT PRIMARY KEY,
+            last_seen TIMESTAMP NOT NULL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_matched_address_last_seen ON matched_address (last_seen)
+    ''')
+
+    # Backfill progress, one row per tx id range (start exclusive, end inclusive)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS backfill_chunk (
+            start_tx_id INTEGER NOT NULL,
+            end_tx_id INTEGER NOT NULL,
+            done_at TIMESTAMP,
+            PRIMARY KEY (start_tx_id, end_tx_id)
+        )
+    ''')
+
+    # Single-row discovery cursor: last processed db-sync block id and tx id,
+    # with the block number and hash to detect rollbacks
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS checkpoint (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            block_id INTEGER NOT NULL,
+            tx_id INTEGER NOT NULL,
+            block_no INTEGER,
+            block_hash TEXT
+        )
+    ''')
+    add_missing_columns(cursor, 'checkpoint', [('block_no', 'INTEGER'), ('block_hash', 'TEXT')])
+
+    # Recently processed tip blocks, searched for the fork point after a rollback
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS recent_block (
+            block_no INTEGER PRIMARY KEY,
+            block_hash TEXT NOT NULL
+        )
+    ''')
+
+    # Resolved db-sync tx outputs, reloaded into the poller's UTxO cache on start
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS utxo_cache (
+            tx_id INTEGER NOT NULL,
+            tx_index INTEGER NOT NULL,
+            address TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            data_hash TEXT,
+            PRIMARY KEY (tx_id, tx_index)
+        )
+    ''')
+
+    conn.commit()
+    return conn
+
+def create_tx_tables(cursor):
+    """Create the tx table and its tx_io and tx_asset child tables"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tx (
+            tx_hash TEXT PRIMARY KEY,
+            tx_date TIMESTAMP,
+            metadata TEXT,                    -- JSON object {key: value}
+            target_lovelace_input INTEGER,
+            target_lovelace_output INTEGER,
+            match_lovelace_input INTEGER,
+            match_lovelace_output INTEGER,
+            target_address TEXT,              -- watched wallet the tx touched
+            matched_address TEXT,
+            tx_type TEXT,    -- CREATION, INCREASE, DECREASE, or DELETION
+            policy_id TEXT,                   -- watched policy that matched
+            block_no INTEGER,
+            block_hash TEXT
+        )
+    ''')
+
+    # One row per input or output, so address lookups hit an index
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tx_io (
+            tx_hash TEXT NOT NULL,
+            direction TEXT NOT NULL,     -- 'in' or 'out'
+            position INTEGER NOT NULL,   -- order within the tx inputs or outputs
+            address TEXT NOT NULL,
+            lovelace INTEGER NOT NULL,
+            spent_tx_hash TEXT,          -- output an input spends, as (tx hash, index)
+            spent_index INTEGER,
+            PRIMARY KEY (tx_hash, direction, position)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tx_io_address ON tx_io (address)
+    ''')
+
+    # Watched policy assets the tx moved, with the net quantity each address received
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS tx_asset (
+            tx_hash TEXT NOT NULL,
+            policy_id TEXT NOT NULL,
+            asset_name TEXT NOT NULL,    -- hex, as in db-sync
+            address TEXT NOT NULL,
+            quantity TEXT NOT NULL,      -- decimal string, token amounts can exceed 64 bits
+            PRIMARY KEY (tx_hash, policy_id, asset_name, address)
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_tx_asset_policy ON tx_asset (policy_id, asset_name)
+    ''')
+
+def add_missing_columns(cursor, table, columns):
+    """Add the (name, type) columns an older database lacks"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    existing = [column[1] for column in cursor.fetchall()]
+    for name, column_type in columns:
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+def parse_legacy_metadata(text):
+    """Parse a str()'d metadata dict into JSON with string keys, as TxWriter.flush writes it.
+
+    db-sync metadata keys are numeric and came out of psycopg2 as Decimal, so
+    the repr reads {Decimal('674'): ...}, which literal_eval rejects.
+    """
+    if not text:
+        return '{}'
+    metadata = ast.literal_eval(re.sub(r"Decimal\('(-?\d+)'\)", r"\1", text))
+    return json.dumps({str(key): value for key, value in metadata.items()})
+
+def parse_legacy_items(items):
+    """Parse a str()'d list of {'address', 'amount'} dicts into (address, lovelace) pairs"""
+    return [(item['address'], round(float(item['amount'] or 0) * 1000000)) for item in ast.literal_eval(items)] if items else []
+
+def migrate_legacy_tx_table(conn):
+    """One-shot migration of str()'d inputs/outputs/metadata and float ADA columns.
+
+    Runs in a single transaction, so a failure leaves the legacy table as it
+    was. A tx_legacy table left behind by an interrupted earlier version of
+    this migration is picked up again.
+    """
+    cursor = conn.cursor()
+    cursor.execute("PRAGMA table_info(tx)")
+    legacy = 'inputs' in [column[1] for column in cursor.fetchall()]
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tx_legacy'")
+    stranded = cursor.fetchone() is not None
+    if not legacy and not stranded:
+        return
+
+    log.info("Migrating local database to the tx_io storage format")
+    conn.commit()
+    # DDL runs outside the implicit transactions of sqlite3, so open one explicitly
+    cursor.execute("BEGIN")
+    try:
+        if legacy:
+            cursor.execute("ALTER TABLE tx RENAME TO tx_legacy")
+        create_tx_tables(cursor)
+
+        def to_lovelace(amount):
+            try:
+                return round(float(amount or 0) * 1000000)
+            except (TypeError, ValueError):
+                return None
+
+        cursor.execute('''
+            SELECT tx_hash, tx_date, metadata,
+                   target_ada_input, target_ada_output, match_ada_input, match_ada_output,
+                   target_address, matched_address, inputs, outputs, tx_type
+            FROM tx_legacy
+        ''')
+        skipped = 0
+        for row in cursor.fetchall():
+            (tx_hash, tx_date, metadata, target_in, target_out, match_in, match_out,
+             target_address, matched_address, inputs, outputs, tx_type) = row
+            try:
+                metadata = parse_legacy_metadata(metadata)
+            except (ValueError, SyntaxError, TypeError, AttributeError):
+                metadata = json.dumps({'raw': metadata})
+            conn.execute(
+                """INSERT OR IGNORE INTO tx (
+                    tx_hash, tx_date, metadata,
+                    target_lovelace_input, target_lovelace_output,
+                    match_lovelace_input, match_lovelace_output,
+                    target_address, matched_address, tx_type
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (tx_hash, tx_date, metadata,
+                 to_lovelace(target_in), to_lovelace(target_out),
+                 to_lovelace(match_in), to_lovelace(match_out),
+                 target_address, matched_address, tx_type)
+            )
+            # Keep the transaction even if its inputs and outputs cannot be read
+            try:
+                io_rows = [
+                    (tx_hash, direction, position, address, lovelace)
+                    for direction, items in (('in', inputs), ('out', outputs))
+                    for position, (address, lovelace) in enumerate(parse_legacy_items(items))
+                ]
+            except (ValueError, SyntaxError, TypeError, KeyError) as e:
+                log.warning(f"Could not migrate inputs/outputs of {tx_hash}: {e!r}")
+                skipped += 1
+                continue
+            conn.executemany(
+                "INSERT OR REPLACE INTO tx_io (tx_hash, direction, position, address, lovelace) VALUES (?, ?, ?, ?, ?)",
+                io_rows
+            )
+
+        cursor.execute("DROP TABLE tx_legacy")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    if skipped:
+        log.warning(f"Migrated without inputs/outputs: {skipped} transactions")
+
+def get_latest_tx_hash(conn):
+    """Get the hash of the most recent saved transaction, or None"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT tx_hash FROM tx ORDER BY tx_date DESC LIMIT 1")
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+def get_checkpoint(conn):
+    """Get the last processed (block_id, tx_id, block_no, block_hash), or None"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT block_id, tx_id, block_no, block_hash FROM checkpoint WHERE id = 0")
+    return cursor.fetchone()
+
+def save_checkpoint(conn, block_id, tx_id, block_no=None, block_hash=None, keep_blocks=0):
+    """Move the checkpoint; committed by the caller after the batches it covers.
+
+    A checkpoint with a block hash is also remembered as a recent tip block,
+    keeping those of the last keep_blocks blocks.
+    """
+    cursor = conn.cursor()
+    cursor.execute(
+        "INSERT OR REPLACE INTO checkpoint (id, block_id, tx_id, block_no, block_hash) VALUES (0, ?, ?, ?, ?)",
+        (block_id, tx_id, block_no, block_hash)
+    )
+    if block_hash is not None:
+        cursor.execute("INSERT OR REPLACE INTO recent_block (block_no, block_hash) VALUES (?, ?)", (block_no, block_hash))
+        cursor.execute("DELETE FROM recent_block WHERE block_no <= ?", (block_no - keep_blocks,))
+
+def get_recent_blocks(conn):
+    """Get the remembered tip blocks as (block_no, block_hash), newest first"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT block_no, block_hash FROM recent_block ORDER BY block_no DESC")
+    return cursor.fetchall()
+
+def get_block_hashes_after(conn, block_no):
+    """Get the distinct block hashes of saved transactions above block_no"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT DISTINCT block_hash FROM tx WHERE block_no > ? AND block_hash IS NOT NULL", (block_no,))
+    return [row[0] for row in cursor.fetchall()]
+
+def delete_rolled_back(conn, block_no, block_hashes):
+    """Forget tip blocks above block_no and delete the transactions of rolled back blocks.
+
+    Unsent alerts of those transactions are dropped. Alerts that were sent,
+    or taken by tlg.py and possibly on their way, get a rollback notice that
+    keeps the policy id for routing. Returns the deleted tx hashes.
+    """
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM recent_block WHERE block_no > ?", (block_no,))
+    block_hashes = list(block_hashes)
+    if not block_hashes:
+        return []
+    cursor.execute(f"SELECT tx_hash FROM tx WHERE block_hash IN ({','.join('?' * len(block_hashes))})", block_hashes)
+    tx_hashes = [row[0] for row in cursor.fetchall()]
+
+    now = datetime.now()
+    cursor.executemany(
+        """INSERT INTO outbox (tx_hash, created_at, kind, policy_id)
+        SELECT tx.tx_hash, ?, 'rollback', tx.policy_id FROM tx
+        WHERE tx.tx_hash = ? AND EXISTS (
+            SELECT 1 FROM outbox
+            WHERE outbox.tx_hash = tx.tx_hash AND kind = 'alert'
+              AND (sent_at IS NOT NULL OR taken_at IS NOT NULL)
+        )""",
+        [(now, tx_hash) for tx_hash in tx_hashes]
+    )
+    cursor.executemany("DELETE FROM outbox WHERE tx_hash = ? AND kind = 'alert' AND sent_at IS NULL", [(tx_hash,) for tx_hash in tx_hashes])
+    cursor.executemany("DELETE FROM tx_io WHERE tx_hash = ?", [(tx_hash,) for tx_hash in tx_hashes])
+    cursor.executemany("DELETE FROM tx_asset WHERE tx_hash = ?", [(tx_hash,) for tx_hash in tx_hashes])
+    cursor.executemany("DELETE FROM tx WHERE tx_hash = ?", [(tx_hash,) for tx_hash in tx_hashes])
+    return tx_hashes
+
+def get_matched_addresses(conn, limit):
+    """Get the limit most recently seen matched addresses as (address, last_seen)"""
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT address, last_seen FROM matched_address ORDER BY last_seen DESC LIMIT ?",
+        (limit,)
+    )
+    return [(address, datetime.fromisoformat(last_seen)) for address, last_seen in cursor.fetchall()]
+
+def delete_matched_addresses(conn, cutoff, limit):
+    """Delete matched addresses last seen before cutoff, keeping at most limit"""
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM matched_address WHERE last_seen < ?", (cutoff,))
+    cursor.execute(
+        """DELETE FROM matched_address WHERE address NOT IN (
+            SELECT address FROM matched_address ORDER BY last_seen DESC LIMIT ?
+        )""",
+        (limit,)
+    )
+
+def get_cached_utxos(conn, limit):
+    """Get the limit most recently saved outputs as ((tx_id, index), (address, value, data_hash)), oldest first"""
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT tx_id, tx_index, address, value, data_hash FROM utxo_cache ORDER BY rowid DESC LIMIT ?",
+        (limit,)
+    )
+    rows = cursor.fetchall()
+    rows.reverse()
+    return [((tx_id, index), (address, value, data_hash)) for tx_id, index, address, value, data_hash in rows]
+
+def save_cached_utxos(conn, rows, keep):
+    """Save (tx_id, index, address, value, data_hash) rows, keeping the keep most recently saved"""
+    if not rows:
+        return
+    cursor = conn.cursor()
+    # A replaced row gets a new rowid, so rowid order is save order
+    cursor.executemany(
+        "INSERT OR REPLACE INTO utxo_cache (tx_id, tx_index, address, value, data_hash) VALUES (?, ?, ?, ?, ?)",
+        [(tx_id, index, address, int(value), data_hash) for tx_id, index, address, value, data_hash in rows]
+    )
+    cursor.execute("DELETE FROM utxo_cache WHERE rowid <= (SELECT MAX(rowid) FROM utxo_cache) - ?", (keep,))
+
+def delete_cached_utxos_after(conn, tx_id):
+    """Delete saved outputs of transactions after tx_id, whose ids a rollback may reuse"""
+    conn.cursor().execute("DELETE FROM utxo_cache WHERE tx_id > ?", (tx_id,))
+
+class TxWriter:
+    """Buffers classified records and writes them with executemany in one transaction.
+
+    Records already in the database are upserted, and only transactions that
+    are new to the database get an outbox alert.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.clear()
+
+    def clear(self):
+        """Drop everything buffered since the last flush"""
+        self.records = {}  # tx_hash -> (record, alert), last write wins
+        self.matched = {}  # address -> last seen
+
+    def add(self, record, alert=True):
+        self.records[record['tx_hash']] = (record, alert)
+
+    def touch(self, address, seen):
+        """Buffer a matched address sighting"""
+        if address not in self.matched or self.matched[address] < seen:
+            self.matched[address] = seen
+
+    def flush(self):
+        """Write the buffered rows and commit; returns the number of new transactions"""
+        cursor = self.conn.cursor()
+        hashes = list(self.records)
+
+        existing = set()
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start:start + 500]
+            cursor.execute(f"SELECT tx_hash FROM tx WHERE tx_hash IN ({','.join('?' * len(chunk))})", chunk)
+            existing.update(row[0] for row in cursor.fetchall())
+
+        records = [record for record, _ in self.records.values()]
+        cursor.executemany(
+            """INSERT INTO tx (
+                tx_hash, tx_date, metadata,
+                target_lovelace_input, target_lovelace_output,
+                match_lovelace_input, match_lovelace_output,
+                target_address, matched_address, tx_type, policy_id,
+                block_no, block_hash
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(tx_hash) DO UPDATE SET
+                tx_date = excluded.tx_date,
+                metadata = excluded.metadata,
+                target_lovelace_input = excluded.target_lovelace_input,
+                target_lovelace_output = excluded.target_lovelace_output,
+                match_lovelace_input = excluded.match_lovelace_input,
+                match_lovelace_output = excluded.match_lovelace_output,
+                target_address = excluded.target_address,
+                matched_address = excluded.matched_address,
+                tx_type = excluded.tx_type,
+                policy_id = excluded.policy_id,
+                block_no = excluded.block_no,
+                block_hash = excluded.block_hash""",
+            [
+                (record['tx_hash'], record['tx_date'],
+                 json.dumps({str(key): value for key, value in record['metadata'].items()}),
+                 record['target_lovelace_input'], record['target_lovelace_output'],
+                 record['match_lovelace_input'], record['match_lovelace_output'],
+                 record['target_address'], record['matched_address'],
+                 record['tx_type'], record['policy_id'],
+                 record['block_no'], record['block_hash'])
+                for record in records
+            ]
+        )
+        cursor.executemany(
+            """INSERT OR REPLACE INTO tx_io (tx_hash, direction, position, address, lovelace, spent_tx_hash, spent_index)
+            VALUES (?, ?, ?, ?, ?, ?, ?)""",
+            [
+                (record['tx_hash'], 'in', position, addr, int(value), *spent)
+                for record in records
+                for position, ((_, _, addr, value), spent) in enumerate(zip(record['inputs'], record['spent']))
+            ] + [
+                (record['tx_hash'], 'out', position, addr, int(value), None, None)
+                for record in records
+                for position, (addr, value) in enumerate(record['outputs'])
+            ]
+        )
+        cursor.executemany(
+            "INSERT OR REPLACE INTO tx_asset (tx_hash, policy_id, asset_name, address, quantity) VALUES (?, ?, ?, ?, ?)",
+            [
+                (record['tx_hash'], policy_id, asset_name, address, str(quantity))
+                for record in records
+                for address, policy_id, asset_name, quantity in record['assets']
+            ]
+        )
+
+        new_hashes = [tx_hash for tx_hash in hashes if tx_hash not in existing]
+        now = datetime.now()
+        cursor.executemany(
+            "INSERT INTO outbox (tx_hash, created_at) VALUES (?, ?)",
+            [(tx_hash, now) for tx_hash in new_hashes if self.records[tx_hash][1]]
+        )
+        cursor.executemany(
+            """INSERT INTO matched_address (address, last_seen) VALUES (?, ?)
+            ON CONFLICT(address) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)""",
+            list(self.matched.items())
+        )
+
+        self.conn.commit()
+        self.clear()
+        return len(new_hashes)
+
+def get_tx_io(conn, tx_hash):
+    """Get the (address, lovelace) inputs and outputs of a transaction"""
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT direction, address, lovelace FROM tx_io WHERE tx_hash = ? ORDER BY direction, position",
+        (tx_hash,)
+    )
+    io = {'in': [], 'out': []}
+    for direction, address, lovelace in cursor.fetchall():
+        io[direction].append((address, lovelace))
+    return io['in'], io['out']
+
+def get_spent_refs(conn, tx_hash=None):
+    """Get the (tx_hash, index) outputs spent by a transaction, or {tx_hash: refs} of all saved ones"""
+    cursor = conn.cursor()
+    if tx_hash is not None:
+        cursor.execute(
+            "SELECT spent_tx_hash, spent_index FROM tx_io WHERE tx_hash = ? AND direction = 'in' AND spent_tx_hash IS NOT NULL ORDER BY position",
+            (tx_hash,)
+        )
+        return [tuple(row) for row in cursor.fetchall()]
+    cursor.execute("SELECT tx_hash, spent_tx_hash, spent_index FROM tx_io WHERE direction = 'in' AND spent_tx_hash IS NOT NULL")
+    refs = {}
+    for tx_hash, spent_tx_hash, spent_index in cursor.fetchall():
+        refs.setdefault(tx_hash, []).append((spent_tx_hash, spent_index))
+    return refs
+
+def get_tx_assets(conn, tx_hash):
+    """Get the (address, policy_id, asset_name, quantity) watched assets a transaction moved"""
+    cursor = conn.cursor()
+    cursor.execute(
+        "SELECT address, policy_id, asset_name, quantity FROM tx_asset WHERE tx_hash = ? ORDER BY policy_id, asset_name",
+        (tx_hash,)
+    )
+    return [(address, policy_id, asset_name, int(quantity)) for address, policy_id, asset_name, quantity in cursor.fetchall()]
+
+# Offer owner (first input that is not the watched contract) and position of
+# the contract output holding the offer, for offers.OfferBook
+OFFER_COLUMNS = """
+    (SELECT address FROM tx_io
+     WHERE tx_io.tx_hash = tx.tx_hash AND direction = 'in' AND address != tx.target_address
+     ORDER BY position LIMIT 1),
+    (SELECT position FROM tx_io
+     WHERE tx_io.tx_hash = tx.tx_hash AND direction = 'out' AND address = tx.target_address
+     ORDER BY position LIMIT 1)
+"""
+
+def get_offer_history(conn):
+    """Get the offer fields of saved transactions oldest first.
+
+    Alerts tlg.py has not taken yet are left out; they are applied when they are sent.
+    """
+    spent = get_spent_refs(conn)
+    cursor = conn.cursor()
+    cursor.execute(f"""
+    SELECT tx.tx_hash, tx.policy_id, tx.target_lovelace_output, {OFFER_COLUMNS}
+    FROM tx
+    WHERE NOT EXISTS (
+        SELECT 1 FROM outbox
+        WHERE outbox.tx_hash = tx.tx_hash AND outbox.kind = 'alert'
+          AND outbox.sent_at IS NULL AND outbox.taken_at IS NULL
+    )
+    ORDER BY tx.tx_date, tx.block_no
+    """)
+    return [
+        {'tx_hash': row[0], 'policy_id': row[1], 'target_lovelace_output': row[2], 'owner': row[3], 'offer_position': row[4],
+         'spent': spent.get(row[0], [])}
+        for row in cursor.fetchall()
+    ]
+
+def get_pending_alerts(conn):
+    """Get unsent outbox entries joined with their transactions, oldest first.
+
+    Rollback notices have no transaction left; only their tx_hash and
+    policy_id are set.
+    """
+    query = f"""
+    SELECT outbox.id, outbox.tx_hash, tx.tx_date, tx.target_lovelace_input, tx.target_lovelace_output,
+           tx.tx_type, COALESCE(tx.policy_id, outbox.policy_id), outbox.kind, {OFFER_COLUMNS}
+    FROM outbox
+    LEFT JOIN tx ON tx.tx_hash = outbox.tx_hash
+    WHERE outbox.sent_at IS NULL
+    ORDER BY outbox.id
+    """
+    cursor = conn.cursor()
+    cursor.execute(query)
+    alerts = []
+    for row in cursor.fetchall():
+        inputs, outputs = get_tx_io(conn, row[1])
+        alerts.append({
+            'outbox_id': row[0],
+            'tx_hash': row[1],
+            'tx_date': row[2],
+            'target_lovelace_input': row[3],
+            'target_lovelace_output': row[4],
+            'inputs': inputs,
+            'outputs': outputs,
+            'assets': get_tx_assets(conn, row[1]),
+            'spent': get_spent_refs(conn, row[1]),
+            'tx_type': row[5],
+            'policy_id': row[6],
+            'kind': row[7],
+            'owner': row[8],
+            'offer_position': row[9]
+        })
+    return alerts
+
+def take_alerts(conn, outbox_ids):
+    """Record that outbox entries are being handed to the sender.
+
+    Returns the ids still in the outbox; a rollback may have deleted the
+    others since they were read, and those must not be sent.
+    """
+    taken_at = datetime.now().isoformat()
+    cursor = conn.cursor()
+    taken = set()
+    for outbox_id in outbox_ids:
+        cursor.execute("UPDATE outbox SET taken_at = ? WHERE id = ?", (taken_at, outbox_id))
+        if cursor.rowcount:
+            taken.add(outbox_id)
+    conn.commit()
+    return taken
+
+def mark_sent(conn, outbox_ids):
+    """Mark outbox alerts as delivered"""
+    sent_at = datetime.now().isoformat()
+    cursor = conn.cursor()
+    cursor.executemany("UPDATE outbox SET sent_at = ? WHERE id = ?", [(sent_at, outbox_id) for outbox_id in outbox_ids])
+    conn.commit()
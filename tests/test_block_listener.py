@@ -0,0 +1,112 @@
+"""BlockListener against a fake LISTEN connection and a recorded sleep"""
+import socket
+import time
+
+import pytest
+
+pytest.importorskip('psycopg2')
+import find_txs
+
+
+class FakeListenConnection:
+    """Stands in for a psycopg2 connection in LISTEN mode.
+
+    select() waits on one end of a socket pair; notify() writes to the other
+    end the way the server's NOTIFY makes the real connection readable.
+    """
+
+    def __init__(self):
+        self.server, self.client = socket.socketpair()
+        self.notifies = []
+        self.polls = 0
+        self.closed = False
+        self.broken = False
+
+    def fileno(self):
+        return self.client.fileno()
+
+    def notify(self, payload='block'):
+        self.server.send(b'N')
+        self.pending = payload
+
+    def poll(self):
+        self.polls += 1
+        if self.broken:
+            raise OSError("server closed the connection unexpectedly")
+        self.client.recv(64)
+        self.notifies.append(self.pending)
+
+    def close(self):
+        self.closed = True
+        self.server.close()
+        self.client.close()
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record polling sleeps instead of waiting"""
+    recorded = []
+    monkeypatch.setattr(find_txs.time, 'sleep', recorded.append)
+    monkeypatch.setattr(find_txs, 'poll_interval_min', 2)
+    monkeypatch.setattr(find_txs, 'poll_interval_max', 20)
+    return recorded
+
+
+def test_notify_wakes_the_listener(monkeypatch):
+    # A long safety interval: only the notification can end the wait quickly
+    monkeypatch.setattr(find_txs, 'poll_interval_max', 10)
+    listener = find_txs.BlockListener({}, 'jpg_sniper_block')
+    listener.conn = conn = FakeListenConnection()
+
+    conn.notify()
+    started = time.monotonic()
+    listener.wait(chain_advanced=False)
+
+    assert time.monotonic() - started < 1
+    assert conn.polls == 1
+    assert conn.notifies == []
+    assert listener.conn is conn
+    listener.close()
+
+
+def test_listener_rechecks_after_the_safety_interval(monkeypatch):
+    monkeypatch.setattr(find_txs, 'poll_interval_max', 0.05)
+    listener = find_txs.BlockListener({}, 'jpg_sniper_block')
+    listener.conn = conn = FakeListenConnection()
+
+    listener.wait(chain_advanced=False)
+
+    assert conn.polls == 0
+    listener.close()
+
+
+def test_listener_error_falls_back_to_polling(sleeps):
+    listener = find_txs.BlockListener({}, 'jpg_sniper_block')
+    listener.conn = conn = FakeListenConnection()
+    conn.notify()
+    conn.broken = True
+
+    listener.wait(chain_advanced=False)
+
+    assert listener.conn is None
+    assert conn.closed
+    assert sleeps == [2]
+
+
+def test_polling_interval_stays_at_minimum_while_the_chain_advances(sleeps):
+    listener = find_txs.BlockListener({}, 'jpg_sniper_block')
+
+    for _ in range(5):
+        listener.wait(chain_advanced=True)
+
+    assert sleeps == [2] * 5
+
+
+def test_polling_backs_off_to_maximum_while_idle(sleeps):
+    listener = find_txs.BlockListener({}, 'jpg_sniper_block')
+
+    for _ in range(6):
+        listener.wait(chain_advanced=False)
+    listener.wait(chain_advanced=True)
+
+    assert sleeps == [4, 8, 16, 20, 20, 20, 2]
@@ -0,0 +1,187 @@
+"""CBOR decoding of Plutus datums, listing parsing and policy matching"""
+import pytest
+
+from datum import MAX_DEPTH, CborError, Constr, PolicyMatcher, decode_cbor, parse_listing
+
+POLICY = bytes.fromhex('aa' * 28)
+OTHER_POLICY = bytes.fromhex('bb' * 28)
+OWNER = bytes.fromhex('cc' * 28)
+
+
+def encode(value):
+    """Minimal Plutus data encoder for building test datums"""
+    def head(major, argument):
+        if argument < 24:
+            return bytes([major << 5 | argument])
+        for info, size in ((24, 1), (25, 2), (26, 4), (27, 8)):
+            if argument < 1 << (8 * size):
+                return bytes([major << 5 | info]) + argument.to_bytes(size, 'big')
+
+    if isinstance(value, Constr):
+        return head(6, 121 + value.index) + encode(value.fields)
+    if isinstance(value, int):
+        return head(0, value) if value >= 0 else head(1, -1 - value)
+    if isinstance(value, bytes):
+        return head(2, len(value)) + value
+    if isinstance(value, dict):
+        return head(5, len(value)) + b''.join(encode(key) + encode(item) for key, item in value.items())
+    return b'\x9f' + b''.join(encode(item) for item in value) + b'\xff'
+
+
+def address(payment):
+    """Plutus base address data with a key hash payment credential"""
+    return Constr(0, [Constr(0, [payment]), Constr(1, [])])
+
+
+def script_address(script_hash):
+    return Constr(0, [Constr(1, [script_hash]), Constr(1, [])])
+
+
+def listing(price, payout_address):
+    """Listing: lovelace payouts to the seller and the marketplace"""
+    return Constr(0, [[Constr(0, [payout_address, price]), Constr(0, [address(bytes(28)), 1000000])], OWNER])
+
+
+def offer(policy, fee):
+    """Collection offer: the buyer is paid out one asset of the policy"""
+    return Constr(0, [[Constr(0, [address(OWNER), {policy: {b'': 1}}]), Constr(0, [address(bytes(28)), fee])], OWNER])
+
+
+@pytest.mark.parametrize('hex_data, expected', [
+    ('00', 0),
+    ('17', 23),
+    ('1818', 24),
+    ('1903e8', 1000),
+    ('1b000000e8d4a51000', 1000000000000),
+    ('20', -1),
+    ('3863', -100),
+    ('43010203', b'\x01\x02\x03'),
+    ('6161', 'a'),
+    ('83010203', [1, 2, 3]),
+    ('a10102', {1: 2}),
+    ('f5', True),
+    ('f6', None),
+])
+def test_definite_lengths(hex_data, expected):
+    assert decode_cbor(bytes.fromhex(hex_data)) == expected
+
+
+@pytest.mark.parametrize('hex_data, expected', [
+    ('9f0102ff', [1, 2]),
+    ('9fff', []),
+    ('5f42010243030405ff', b'\x01\x02\x03\x04\x05'),
+    ('7f61616162ff', 'ab'),
+    ('bf616101ff', {'a': 1}),
+    ('bf61610161629f02ffff', {'a': 1, 'b': [2]}),
+])
+def test_indefinite_lengths(hex_data, expected):
+    assert decode_cbor(bytes.fromhex(hex_data)) == expected
+
+
+def test_map_keys_are_frozen():
+    # An array used as a map key must still be hashable
+    assert decode_cbor(bytes.fromhex('a1820102f5')) == {(1, 2): True}
+
+
+@pytest.mark.parametrize('hex_data, expected', [
+    ('d87980', Constr(0, [])),
+    ('d8799f01ff', Constr(0, [1])),
+    ('d87f80', Constr(6, [])),
+    ('d9050080', Constr(7, [])),
+    ('d9057880', Constr(127, [])),
+    ('d8668205820102', Constr(5, [1, 2])),
+])
+def test_constr_tags(hex_data, expected):
+    value = decode_cbor(bytes.fromhex(hex_data))
+    assert value == expected
+    assert isinstance(value, Constr)
+
+
+def test_bignums():
+    assert decode_cbor(bytes.fromhex('c249010000000000000000')) == 2 ** 64
+    assert decode_cbor(bytes.fromhex('c349010000000000000000')) == -1 - 2 ** 64
+
+
+@pytest.mark.parametrize('hex_data', [
+    '',
+    '581caaaa',        # byte string shorter than its length
+    '8301',            # array missing items
+    '19ff',            # truncated argument
+    '9f01',            # indefinite array without a break
+    '0101',            # trailing bytes
+    '1c',              # reserved additional info
+])
+def test_invalid_input(hex_data):
+    with pytest.raises(CborError):
+        decode_cbor(bytes.fromhex(hex_data))
+
+
+def test_nesting_up_to_the_limit():
+    assert decode_cbor(b'\x81' * MAX_DEPTH + b'\x00') is not None
+
+
+@pytest.mark.parametrize('prefix', [b'\x81', b'\x9f', b'\xd8\x79'])
+def test_deep_nesting_is_rejected(prefix):
+    with pytest.raises(CborError):
+        decode_cbor(prefix * 3000 + b'\x58\x1c' + POLICY)
+
+
+def test_parse_listing():
+    parsed = parse_listing(decode_cbor(encode(listing(50000000, address(OWNER)))))
+    assert parsed['price'] == 51000000
+    assert parsed['owner'] == OWNER.hex()
+    assert parsed['policies'] == frozenset()
+
+
+def test_parse_offer():
+    parsed = parse_listing(decode_cbor(encode(offer(POLICY, 2000000))))
+    # The Value map carries no lovelace; only the marketplace fee counts
+    assert parsed['price'] == 2000000
+    assert parsed['policies'] == {POLICY}
+
+
+def test_parse_other_datum():
+    parsed = parse_listing(decode_cbor(encode(Constr(1, [POLICY, 5]))))
+    assert parsed['price'] is None
+    assert parsed['policies'] == frozenset()
+    assert parsed['hashes'] == {POLICY}
+
+
+def test_match_offer_datum():
+    matcher = PolicyMatcher([POLICY.hex()])
+    policy_id, parsed = matcher.match(b'offer', encode(offer(POLICY, 2000000)))
+    assert policy_id == POLICY.hex()
+    assert parsed['policies'] == {POLICY}
+
+
+def test_match_ignores_listing_payout_credentials():
+    # The watched id appears as a payout script hash, not as a paid out asset
+    matcher = PolicyMatcher([POLICY.hex()])
+    policy_id, parsed = matcher.match(b'listing', encode(listing(50000000, script_address(POLICY))))
+    assert policy_id is None
+    assert parsed['price'] == 51000000
+
+
+def test_match_other_policy():
+    matcher = PolicyMatcher([POLICY.hex()])
+    assert matcher.match(b'offer', encode(offer(OTHER_POLICY, 2000000))) == (None, None)
+
+
+def test_match_non_listing_datum_by_field():
+    matcher = PolicyMatcher([POLICY.hex()])
+    policy_id, parsed = matcher.match(b'other', encode(Constr(1, [POLICY, 5])))
+    assert policy_id == POLICY.hex()
+
+
+def test_match_deeply_nested_datum():
+    # Not decodable as CBOR, so the raw byte hit decides
+    matcher = PolicyMatcher([POLICY.hex()])
+    assert matcher.match(b'deep', b'\x81' * 3000 + b'\x58\x1c' + POLICY) == (POLICY.hex(), None)
+
+
+def test_match_caches_decoded_datums():
+    matcher = PolicyMatcher([POLICY.hex()])
+    raw = encode(offer(POLICY, 2000000))
+    first = matcher.match(b'offer', raw)
+    assert matcher.match(b'offer', raw) == first
+    assert list(matcher.cache) == [b'offer']
@@ -0,0 +1,103 @@
+"""Migration of databases written by the original find_txs.py"""
+import json
+import sqlite3
+from decimal import Decimal
+
+import pytest
+
+import storage
+
+# The tx table as the original find_txs.py created it
+LEGACY_SCHEMA = '''
+    CREATE TABLE tx (
+        tx_hash TEXT PRIMARY KEY,
+        tx_date TIMESTAMP,
+        metadata TEXT,
+        target_ada_input REAL,
+        target_ada_output REAL,
+        match_ada_input REAL,
+        match_ada_output REAL,
+        target_address TEXT,
+        matched_address TEXT,
+        inputs TEXT,     -- JSON string of inputs [{address, amount}, ...]
+        outputs TEXT,    -- JSON string of outputs [{address, amount}, ...]
+        tx_type TEXT     -- CREATION, INCREASE, DECREASE, or DELETION
+    )
+'''
+
+
+def insert_legacy(conn, tx_hash, metadata, inputs, outputs):
+    """Insert a row the way the original code did: str() of the Python values"""
+    conn.execute(
+        "INSERT INTO tx VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        (tx_hash, '2024-06-01T12:00:00', str(metadata), 10.5, 20.0, 0.0, 0.0,
+         'addr1wallet', 'addr1match', str(inputs), str(outputs), 'INCREASE')
+    )
+
+
+@pytest.fixture
+def legacy_db(tmp_path):
+    path = str(tmp_path / 'local_transactions.db')
+    conn = sqlite3.connect(path)
+    conn.execute(LEGACY_SCHEMA)
+    # db-sync metadata keys are numeric; psycopg2 returns them as Decimal
+    insert_legacy(
+        conn, 'aa' * 32,
+        {Decimal('674'): {'msg': ['jpg.store offer']}, Decimal('30'): 'f0ff48bbb7bbe9d59a40f1ce90e9e9d0ff5002ec48f232b49ca0fb9a::offer'},
+        [{'address': 'addr1wallet', 'amount': 10.5}],
+        [{'address': 'addr1contract', 'amount': 20.0}, {'address': 'addr1wallet', 'amount': 1.234567}],
+    )
+    insert_legacy(conn, 'bb' * 32, {}, [], [])
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_migrates_baseline_rows(legacy_db):
+    conn = storage.init_local_db(legacy_db)
+
+    metadata, target_in, target_out = conn.execute(
+        "SELECT metadata, target_lovelace_input, target_lovelace_output FROM tx WHERE tx_hash = ?", ('aa' * 32,)
+    ).fetchone()
+    assert json.loads(metadata) == {
+        '674': {'msg': ['jpg.store offer']},
+        '30': 'f0ff48bbb7bbe9d59a40f1ce90e9e9d0ff5002ec48f232b49ca0fb9a::offer',
+    }
+    assert (target_in, target_out) == (10500000, 20000000)
+    assert storage.get_tx_io(conn, 'aa' * 32) == (
+        [('addr1wallet', 10500000)],
+        [('addr1contract', 20000000), ('addr1wallet', 1234567)],
+    )
+    assert json.loads(conn.execute("SELECT metadata FROM tx WHERE tx_hash = ?", ('bb' * 32,)).fetchone()[0]) == {}
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'tx_legacy'").fetchone() is None
+
+
+def test_unreadable_rows_are_kept(legacy_db):
+    conn = sqlite3.connect(legacy_db)
+    conn.execute(
+        "INSERT INTO tx VALUES ('cc', '2024-06-02T00:00:00', 'garbage(', 1, 'x', 0, 0, 'w', 'm', '[{broken', '[]', 'DELETION')"
+    )
+    conn.commit()
+    conn.close()
+
+    conn = storage.init_local_db(legacy_db)
+
+    metadata, target_out = conn.execute("SELECT metadata, target_lovelace_output FROM tx WHERE tx_hash = 'cc'").fetchone()
+    assert json.loads(metadata) == {'raw': 'garbage('}
+    assert target_out is None
+    assert storage.get_tx_io(conn, 'cc') == ([], [])
+    assert conn.execute("SELECT COUNT(*) FROM tx").fetchone()[0] == 3
+
+
+def test_failed_migration_leaves_the_legacy_table(legacy_db, monkeypatch):
+    def fail(items):
+        raise RuntimeError("disk full")
+    monkeypatch.setattr(storage, 'parse_legacy_items', fail)
+
+    with pytest.raises(RuntimeError):
+        storage.init_local_db(legacy_db)
+
+    conn = sqlite3.connect(legacy_db)
+    assert [row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")] == ['tx']
+    assert 'inputs' in [column[1] for column in conn.execute("PRAGMA table_info(tx)")]
+    assert conn.execute("SELECT COUNT(*) FROM tx").fetchone()[0] == 2
@@ -0,0 +1,95 @@
+"""TelegramSender.send outcomes against a fake Bot API server"""
+import http.server
+import json
+import threading
+
+import pytest
+
+pytest.importorskip('requests')
+import tlg
+
+
+class FakeBotApi(http.server.BaseHTTPRequestHandler):
+    """Answers sendMessage with the queued (status, body) responses, then with success"""
+
+    responses = []
+    requests = []
+
+    def do_POST(self):
+        self.requests.append(json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0)))))
+        status, body = self.responses.pop(0) if self.responses else (200, {'ok': True, 'result': {}})
+        body = body if isinstance(body, bytes) else json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """Fake server and a sender pointed at it; sleeps are recorded instead of waited"""
+    handler = type('Handler', (FakeBotApi,), {'responses': [], 'requests': []})
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    sleeps = []
+    monkeypatch.setattr(tlg.time, 'sleep', sleeps.append)
+    monkeypatch.setattr(tlg, 'CHAT_RATE_PER_SECOND', 1e9)
+    sender = tlg.TelegramSender('token', api_url=f"http://127.0.0.1:{server.server_address[1]}")
+    yield sender, handler, sleeps
+    server.shutdown()
+    server.server_close()
+
+
+def error(status, description, **extra):
+    return status, {'ok': False, 'error_code': status, 'description': description, **extra}
+
+
+def test_delivered(api):
+    sender, handler, _ = api
+    assert sender.send('1', 'hello')
+    assert handler.requests[0]['chat_id'] == '1'
+
+
+def test_unparsable_message_is_dropped(api):
+    sender, handler, _ = api
+    handler.responses.append(error(400, "Bad Request: can't parse entities: Unsupported start tag"))
+    assert sender.send('1', '<b>broken')
+    assert '1' not in sender.held
+
+
+@pytest.mark.parametrize('response', [
+    error(400, "Bad Request: chat not found"),
+    error(400, "Bad Request: something new"),
+    (400, b'not json'),
+    error(401, "Unauthorized"),
+    error(403, "Forbidden: bot was blocked by the user"),
+])
+def test_refused_chat_is_held(api, response):
+    sender, handler, _ = api
+    handler.responses.append(response)
+    assert not sender.send('1', 'hello')
+    assert '1' in sender.held
+    # Held chats are not retried until the hold-off passes
+    assert not sender.send('1', 'hello')
+    assert len(handler.requests) == 1
+    # Other chats are unaffected
+    assert sender.send('2', 'hello')
+
+
+def test_rate_limit_waits_retry_after(api):
+    sender, handler, sleeps = api
+    handler.responses.append(error(429, "Too Many Requests: retry after 7", parameters={'retry_after': 7}))
+    assert sender.send('1', 'hello')
+    assert sleeps == [7.0]
+    assert len(handler.requests) == 2
+
+
+def test_rate_limit_without_json_body(api):
+    sender, handler, sleeps = api
+    handler.responses.append((429, b'<html>Too Many Requests</html>'))
+    assert sender.send('1', 'hello')
+    assert sleeps == [1]
@@ -1,160 +1,384 @@
-import sqlite3
+import html
+import logging
 import time
 from datetime import datetime
-import os
+import queue
+import select
+import socket
+import threading
 import requests
-import json
-import ast
-
-# Update constants to read from files
-try:
-    with open('files/telegram.token', 'r') as f:
-        BOT_TOKEN = f.read().strip()
-    with open('files/user.id', 'r') as f:
-        CHAT_ID = f.read().strip()
-    with open('files/wallet.addr', 'r') as f:
-        WALLET_ADDR = f.read().strip()
-except FileNotFoundError as e:
-    print(f"Error: Required file not found - {e}")
-    exit(1)
-
-def send_telegram_message(message):
-    try:
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
+
+import metrics
+import storage
+from offers import OfferBook
+
+# Local UDP port find_txs.py signals after committing new alerts
+ALERT_SIGNAL_PORT = 47831
+
+TELEGRAM_API_URL = "https://api.telegram.org"
+
+# Telegram allows about one message per second to the same chat, with short bursts
+CHAT_RATE_PER_SECOND = 1.0
+CHAT_BURST = 3
+MAX_MESSAGE_LENGTH = 4096
+SEND_ATTEMPTS = 5
+
+# Hold-off in seconds for a chat after Telegram refuses it (bad token, bot
+# blocked, chat not found), doubled on each refusal; its alerts stay unsent
+HOLD_MIN = 30
+HOLD_MAX = 900
+
+# Descriptions of 400 Bad Request errors about the message itself, which no
+# retry will fix. Other 400s, such as "chat not found", are about the chat
+# and are held off like 401/403 so the alerts stay in the outbox
+CONTENT_ERRORS = ("can't parse entities", "message is too long", "message text is empty", "text must be non-empty")
+
+# Local port of the Prometheus metrics endpoint of the notifier (None disables it)
+METRICS_PORT = 9109
+
+log = logging.getLogger('tlg')
+
+send_seconds = metrics.Histogram('tlg_send_seconds', "Telegram sendMessage request latency")
+send_failures = metrics.Counter('tlg_send_failures_total', "Failed Telegram sendMessage attempts, by reason")
+messages_sent = metrics.Counter('tlg_messages_sent_total', "Messages delivered to Telegram")
+outbox_pending = metrics.Gauge('tlg_outbox_pending', "Unsent alerts in the outbox")
+
+class TokenBucket:
+    """Token bucket rate limiter for one chat"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def acquire(self):
+        """Block until a token is available and take it"""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.rate)
+
+class TelegramSender(threading.Thread):
+    """Background Telegram sender that coalesces bursts, rate limits per chat and retries.
+
+    Messages are submitted with the outbox ids they cover; the outcome of each
+    send is reported on the results queue as (outbox_ids, done). done is False
+    when the send should be retried later, so unsent alerts stay in the outbox.
+    """
+
+    def __init__(self, token, api_url=TELEGRAM_API_URL):
+        super().__init__(daemon=True)
+        self.api_url = api_url
+        self.set_token(token)
+        self.session = requests.Session()
+        self.queue = queue.Queue()
+        self.results = queue.Queue()
+        self.buckets = {}
+        self.held = {}  # chat_id -> (monotonic time to retry at, hold-off in seconds)
+
+    def set_token(self, token):
+        self.url = f"{self.api_url}/bot{token}/sendMessage"
+
+    def submit(self, chat_id, message, outbox_ids=()):
+        self.queue.put((chat_id, message, tuple(outbox_ids)))
+
+    def flush(self, timeout):
+        """Wait up to timeout seconds for queued messages to be sent"""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            # Take everything else that is already queued
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            failed = set()
+            for chat_id, text, outbox_ids in coalesce(batch):
+                # After a failure the chat's later messages wait too, so they stay in order
+                done = False
+                if chat_id not in failed:
+                    try:
+                        done = self.send(chat_id, text)
+                    except Exception as e:
+                        log.exception(f"Error sending Telegram message: {e}")
+                        send_failures.inc(reason='error')
+                if not done:
+                    failed.add(chat_id)
+                self.results.put((outbox_ids, done))
+            for _ in batch:
+                self.queue.task_done()
+
+    def send(self, chat_id, text):
+        """Send one message; returns False if it should be retried later"""
+        held = self.held.get(chat_id)
+        if held is not None and time.monotonic() < held[0]:
+            return False
+        bucket = self.buckets.setdefault(chat_id, TokenBucket(CHAT_RATE_PER_SECOND, CHAT_BURST))
         payload = {
-            "chat_id": CHAT_ID,
-            "text": message,
+            "chat_id": chat_id,
+            "text": text,
             "parse_mode": "HTML",
             "disable_web_page_preview": True
         }
-        response = requests.post(url, json=payload)
-        response.raise_for_status()
-    except Exception as e:
-        print(f"Error sending Telegram message: {e}")
+        for attempt in range(SEND_ATTEMPTS):
+            bucket.acquire()
+            try:
+                with send_seconds.time():
+                    response = self.session.post(self.url, json=payload, timeout=10)
+            except requests.RequestException as e:
+                log.warning(f"Error sending Telegram message: {e}")
+                send_failures.inc(reason='network')
+                time.sleep(2 ** attempt)
+                continue
+
+            if response.status_code == 429:
+                # Flood control: wait exactly as long as Telegram asks
+                try:
+                    retry_after = float(response.json()['parameters']['retry_after'])
+                except (ValueError, KeyError, TypeError):
+                    retry_after = 1
+                log.warning(f"Telegram rate limit hit, retrying in {retry_after}s")
+                send_failures.inc(reason='rate_limited')
+                time.sleep(retry_after)
+            elif response.status_code >= 500:
+                log.warning(f"Telegram server error {response.status_code}, retrying")
+                send_failures.inc(reason='server_error')
+                time.sleep(2 ** attempt)
+            elif response.status_code == 400 and is_content_error(response):
+                # A malformed message will never go through; drop it instead of blocking the outbox
+                log.error(f"Telegram rejected message ({response.status_code}): {response.text}")
+                send_failures.inc(reason='rejected')
+                return True
+            elif not response.ok:
+                # Bad token, bot blocked or chat not found (a 400): keep the alerts and retry later
+                delay = min(held[1] * 2, HOLD_MAX) if held is not None else HOLD_MIN
+                self.held[chat_id] = (time.monotonic() + delay, delay)
+                log.error(f"Telegram refused chat {chat_id} ({response.status_code}): {response.text}, retrying in {delay}s")
+                send_failures.inc(reason='refused')
+                return False
+            else:
+                self.held.pop(chat_id, None)
+                messages_sent.inc()
+                return True
+        send_failures.inc(reason='gave_up')
+        return False
+
+def is_content_error(response):
+    """Whether a 400 response blames the message text rather than the chat"""
+    try:
+        description = str(response.json().get('description', ''))
+    except (ValueError, AttributeError):
+        return False
+    return any(error in description.lower() for error in CONTENT_ERRORS)
+
+def split_message(text):
+    """Split text on line boundaries into parts that fit the size limit.
+
+    Alerts open and close their HTML tags on the same line, so every part
+    stays valid HTML. Only a single line over the limit is cut.
+    """
+    parts = []
+    current = ''
+    for line in text.split('\n'):
+        line = line[:MAX_MESSAGE_LENGTH]
+        if current and len(current) + 1 + len(line) > MAX_MESSAGE_LENGTH:
+            parts.append(current)
+            current = line
+        else:
+            current = f"{current}\n{line}" if current else line
+    parts.append(current)
+    return parts
+
+def coalesce(batch):
+    """Merge consecutive messages to the same chat into as few messages as fit the size limit.
+
+    A message over the limit is split; its outbox ids go with its last part.
+    """
+    merged = []
+    for chat_id, message, ids in batch:
+        parts = split_message(message)
+        for position, text in enumerate(parts):
+            outbox_ids = ids if position == len(parts) - 1 else ()
+            if merged and merged[-1][0] == chat_id and len(merged[-1][1]) + 2 + len(text) <= MAX_MESSAGE_LENGTH:
+                last_chat_id, last_text, last_ids = merged[-1]
+                merged[-1] = (chat_id, f"{last_text}\n\n{text}", last_ids + outbox_ids)
+            else:
+                merged.append((chat_id, text, outbox_ids))
+    return merged
 
 def truncate_address(address):
     if len(address) > 15:
         return f"{address[:10]}...{address[-10:]}"
     return address
 
-def format_json_field(json_str):
+def format_io(items, wallets=frozenset()):
+    formatted_str = ""
+    for address, lovelace in items:
+        # Use $YOU for your wallet, truncate other addresses
+        display_address = "$me" if address in wallets else truncate_address(address)
+        # formatted_str += (
+        #     f"📍 <b>Address:</b> <code>{display_address}</code>\n"
+        #     f"💰 <b>Amount:</b> {lovelace / 1000000:.6f} ADA\n"
+        #     "──────────────\n"
+        # )
+        formatted_str += (
+        f"📍<code>{display_address}</code>\n"
+        f"💰 {lovelace / 1000000:.6f} ADA\n"
+        "──────────────\n"
+        )
+    return formatted_str.strip() if formatted_str else "No data available"
+
+def asset_label(asset_name):
+    """Show a hex asset name as text when it is printable UTF-8"""
     try:
-        data = ast.literal_eval(json_str)
-        
-        formatted_str = ""
-        for item in data:
-            if isinstance(item, dict):
-                if 'address' in item and 'amount' in item:
-                    # Use $YOU for your wallet, truncate other addresses
-                    display_address = "$me" if item['address'] == WALLET_ADDR else truncate_address(item['address'])
-                    # formatted_str += (
-                    #     f"📍 <b>Address:</b> <code>{display_address}</code>\n"
-                    #     f"💰 <b>Amount:</b> {item['amount']:.6f} ADA\n"
-                    #     "──────────────\n"
-                    # )
-                    formatted_str += (
-                    f"📍<code>{display_address}</code>\n"
-                    f"💰 {item['amount']:.6f} ADA\n"
-                    "──────────────\n"
-                    )
-        return formatted_str.strip() if formatted_str else "No data available"
-    except Exception as e:
-        print(f"Error: {e}")
-        print(f"Problematic string: {json_str}")
-        return f"Error parsing data: {str(e)}"
-
-def get_latest_transaction(db_path):
+        name = bytes.fromhex(asset_name).decode('utf-8')
+    except ValueError:
+        return asset_name
+    return html.escape(name) if name and name.isprintable() else asset_name
+
+def format_alert(tx, insights=(), wallets=frozenset()):
+    # Convert the date string to datetime object
+    tx_date = datetime.strptime(tx['tx_date'], '%Y-%m-%dT%H:%M:%S')
+    # Format UTC+0
+    utc_date = tx_date.strftime('%d/%m/%Y %H:%M:%S')
+    # Calculate UTC-3
+    utc_minus_3 = tx_date.replace(hour=(tx_date.hour - 3) % 24)
+    utc_minus_3_date = utc_minus_3.strftime('%H:%M:%S')
+    # Offer book context, e.g. a new best offer on the policy
+    insight_text = ''.join(f"{line}\n" for line in insights)
+    # Watched assets that changed hands, when db-sync showed them
+    asset_text = ''.join(
+        f"<b>Asset:</b> {asset_label(asset_name)}{f' ×{quantity}' if quantity != 1 else ''}\n"
+        for _, _, asset_name, quantity in tx.get('assets', ())
+    )
+
+    return (
+        f"{utc_date} ({utc_minus_3_date} UTC-3)\n"
+        f"<a href='https://cexplorer.io/tx/{tx['tx_hash']}'>{tx['tx_hash']}</a>\n"
+        f"<b>Policy:</b> <code>{truncate_address(tx['policy_id'] or '?')}</code>\n"
+        f"{asset_text}\n"
+        # f"<b>Transaction Type:</b> {tx['tx_type']}\n"
+        # f"<b>ADA Input........:</b> {tx['target_ada_input']}\n"
+        f"<b>Offer:</b> {tx['target_ada_output']} ADA\n"
+        f"({tx['target_ada_input']} {tx['tx_type']} {tx['target_ada_output'] - tx['target_ada_input']} ADA)\n"
+        f"{insight_text}\n"
+        # f"<b>ADA Difference:</b> {tx['target_ada_output'] - tx['target_ada_input']}\n\n"
+        f"<b>Inputs:</b>\n{format_io(tx['inputs'], wallets)}\n\n"
+        f"<b>Outputs:</b>\n{format_io(tx['outputs'], wallets)}"
+    )
+
+def format_rollback(tx):
+    return (
+        f"⚠️ <b>Rolled back</b>\n"
+        f"<a href='https://cexplorer.io/tx/{tx['tx_hash']}'>{tx['tx_hash']}</a>\n"
+        f"The block of this transaction was rolled back; disregard its alert."
+    )
+
+def open_wake_socket():
+    """Bind the UDP socket find_txs.py signals on, or None if the port is taken"""
     try:
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor()
-        
-        # Updated query to include tx_type
-        query = """
-        SELECT tx_hash, tx_date, target_ada_input, target_ada_output, inputs, outputs, tx_type 
-        FROM tx 
-        ORDER BY tx_date DESC 
-        LIMIT 1
-        """
-        
-        cursor.execute(query)
-        result = cursor.fetchone()
-        
-        if result:
-            latest_tx = {
-                'tx_hash': result[0],
-                'tx_date': result[1],
-                'target_ada_input': result[2],
-                'target_ada_output': result[3],
-                'inputs': result[4],
-                'outputs': result[5],
-                'tx_type': result[6]
-            }
-            return latest_tx
-        
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', ALERT_SIGNAL_PORT))
+        sock.setblocking(False)
+        return sock
+    except OSError as e:
+        log.warning(f"Wake-up socket unavailable ({e}), relying on polling")
         return None
-        
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
-        return None
-    finally:
-        conn.close()
 
-def monitor_database(db_path, check_interval=10):
-    last_modified = 0
-    latest_tx = None
+def wait_for_signal(sock, timeout):
+    """Sleep until find_txs.py signals new alerts or the timeout passes"""
+    if sock is None:
+        time.sleep(timeout)
+        return
+    if select.select([sock], [], [], timeout)[0]:
+        # Drain queued signals; one outbox pass handles them all
+        try:
+            while sock.recv(16):
+                pass
+        except BlockingIOError:
+            pass
+
+def monitor_database(db_path, config, check_interval=0.5):
+    # Make sure the schema exists, then read on a long-lived read-only connection
+    # and write delivery marks on a separate one, so reads never wait on find_txs.py
+    storage.init_local_db(db_path).close()
+    reader = storage.connect_reader(db_path)
+    writer = storage.connect(db_path)
+    sock = open_wake_socket()
+    sender = TelegramSender(config.bot_token)
+    sender.start()
+    in_flight = set()  # Outbox ids handed to the sender but not yet confirmed
+
+    # Offers as of the last alert handed to the sender
+    book = OfferBook()
+    book.rebuild(storage.get_offer_history(reader))
+    log.info(f"Loaded {len(book.offers)} live offers")
     
-    print(f"Monitoring database at: {db_path}")
-    send_telegram_message("🔄 Bot started monitoring transactions")
+    if METRICS_PORT is not None:
+        metrics.serve(METRICS_PORT)
+    log.info(f"Monitoring database at: {db_path}")
+    sender.submit(config.chat_id, "🔄 Bot started monitoring transactions")
     
     while True:
         try:
-            current_modified = os.path.getmtime(db_path)
-            
-            if current_modified > last_modified:
-                print("\nDatabase change detected!")
-                new_tx = get_latest_transaction(db_path)
-                
-                if new_tx != latest_tx:
-                    latest_tx = new_tx
-                    # Convert the date string to datetime object
-                    tx_date = datetime.strptime(latest_tx['tx_date'], '%Y-%m-%dT%H:%M:%S')
-                    # Format UTC+0
-                    utc_date = tx_date.strftime('%d/%m/%Y %H:%M:%S')
-                    # Calculate UTC-3
-                    utc_minus_3 = tx_date.replace(hour=(tx_date.hour - 3) % 24)
-                    utc_minus_3_date = utc_minus_3.strftime('%H:%M:%S')
-                    
-                    message = (
-                        f"{utc_date} ({utc_minus_3_date} UTC-3)\n"
-                        f"<a href='https://cexplorer.io/tx/{latest_tx['tx_hash']}'>{latest_tx['tx_hash']}</a>\n\n"
-                        # f"<b>Transaction Type:</b> {latest_tx['tx_type']}\n"
-                        # f"<b>ADA Input........:</b> {latest_tx['target_ada_input']}\n"
-                        f"<b>Offer:</b> {latest_tx['target_ada_output']} ADA\n"
-                        f"({latest_tx['target_ada_input']} {latest_tx['tx_type']} {latest_tx['target_ada_output'] - latest_tx['target_ada_input']} ADA)\n\n"
-                        # f"<b>ADA Difference:</b> {latest_tx['target_ada_output'] - latest_tx['target_ada_input']}\n\n"
-                        f"<b>Inputs:</b>\n{format_json_field(latest_tx['inputs'])}\n\n"
-                        f"<b>Outputs:</b>\n{format_json_field(latest_tx['outputs'])}"
-                    )
-                    send_telegram_message(message)
-                    print(message)
-                
-                last_modified = current_modified
-            
-            time.sleep(check_interval)
+            # Edited settings apply from the next alert
+            if 'bot_token' in config.reload():
+                sender.set_token(config.bot_token)
+
+            # Record finished sends; failed ones drop out of in_flight and are retried
+            while True:
+                try:
+                    outbox_ids, done = sender.results.get_nowait()
+                except queue.Empty:
+                    break
+                in_flight.difference_update(outbox_ids)
+                if done and outbox_ids:
+                    storage.mark_sent(writer, outbox_ids)
+
+            # Hand new outbox rows to the sender in order, once they are marked
+            # as taken so a rollback from here on retracts them with a notice
+            pending = storage.get_pending_alerts(reader)
+            outbox_pending.set(len(pending))
+            new = [alert for alert in pending if alert['outbox_id'] not in in_flight]
+            taken = storage.take_alerts(writer, [alert['outbox_id'] for alert in new]) if new else set()
+            for alert in new:
+                if alert['outbox_id'] not in taken:
+                    continue
+                if alert['kind'] == 'rollback':
+                    message = format_rollback(alert)
+                    # Rolled back rows are gone from the database; replay what is left
+                    book.rebuild(storage.get_offer_history(reader))
+                else:
+                    alert['target_ada_input'] = alert['target_lovelace_input'] / 1000000
+                    alert['target_ada_output'] = alert['target_lovelace_output'] / 1000000
+                    message = format_alert(alert, book.describe(book.apply(alert)), config.wallets)
+                # Policies without a route in policy.routes go to user.id
+                chat_id = config.policy_routes.get(alert['policy_id'], config.chat_id)
+                sender.submit(chat_id, message, [alert['outbox_id']])
+                in_flight.add(alert['outbox_id'])
+                log.debug(message)
+
+            wait_for_signal(sock, check_interval)
             
         except KeyboardInterrupt:
-            send_telegram_message("🛑 Bot stopped monitoring")
-            print("\nMonitoring stopped by user")
+            sender.submit(config.chat_id, "🛑 Bot stopped monitoring")
+            sender.flush(timeout=5)
+            log.info("Monitoring stopped by user")
             break
         except Exception as e:
-            error_message = f"❌ Error: {str(e)}"
-            send_telegram_message(error_message)
-            print(f"Error: {e}")
+            log.exception(f"Error: {e}")
             time.sleep(check_interval)
 
 if __name__ == "__main__":
-    # Update database path
-    db_path = "local_transactions.db"
-    
-    # Start monitoring
-    monitor_database(db_path)
+    import cli
+    cli.main(default_command='notify')
@@ -0,0 +1,58 @@
+import collections
+import threading
+
+class UtxoCache:
+    """Bounded LRU cache of resolved tx outputs: (tx_id, index) -> (address, value, data_hash).
+
+    Outputs never change once they are on chain. An entry only goes stale when
+    db-sync rolls back and reuses its tx ids, which discard_after() handles.
+    Entries added since the last take_new() are tracked so the caller can
+    persist them. Safe to share between enrichment threads.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.new = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_many(self, refs):
+        """Return ({ref: output} of cached refs, [refs not in the cache])"""
+        found, missing = {}, []
+        with self.lock:
+            for ref in refs:
+                output = self.entries.get(ref)
+                if output is None:
+                    missing.append(ref)
+                else:
+                    self.entries.move_to_end(ref)
+                    found[ref] = output
+        return found, missing
+
+    def put_many(self, items, persist=True):
+        """Add (ref, output) pairs, evicting the least recently used beyond capacity"""
+        with self.lock:
+            for ref, output in items:
+                self.entries[ref] = output
+                self.entries.move_to_end(ref)
+                if persist:
+                    self.new[ref] = output
+            while len(self.entries) > self.capacity:
+                ref, _ = self.entries.popitem(last=False)
+                self.new.pop(ref, None)
+
+    def discard_after(self, tx_id):
+        """Drop the outputs of transactions after tx_id"""
+        with self.lock:
+            for ref in [ref for ref in self.entries if ref[0] > tx_id]:
+                del self.entries[ref]
+                self.new.pop(ref, None)
+
+    def take_new(self):
+        """Return the entries added since the last call as (tx_id, index, address, value, data_hash) rows"""
+        with self.lock:
+            new, self.new = self.new, {}
+        return [(tx_id, index, *output) for (tx_id, index), output in new.items()]